@@ -1,11 +1,32 @@
 import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
 from hypervisor import logger
 
+try:
+    from ssh2.session import Session as SSH2Session
+except ImportError:
+    SSH2Session = None
+
+try:
+    from pssh.clients import ParallelSSHClient
+except ImportError:
+    ParallelSSHClient = None
+
 
 class SSHConnect:
     """Extended SSHClient allowing custom methods"""
 
+    # the paramiko clients shared by all the instances for the same server,
+    # with the number of instances using each of them, _pool_lock guards the
+    # dicts, the lock of each server guards its connect and close
+    _pool = {}
+    _pool_users = {}
+    _pool_locks = {}
+    _pool_lock = threading.Lock()
+
     def __init__(self, host, user, pwd=None, rsafile=None, port=22, timeout=1800):
         """
         :param str host: The hostname or ip of the server to establish connection.
@@ -22,6 +43,12 @@ class SSHConnect:
         self.port = port
         self.timeout = timeout
         self.err = "passwd or rsafile can not be None"
+        self._client = None
+        self._ssh2 = None
+        self.backend = os.environ.get("HYPERVISOR_SSH_BACKEND", "paramiko")
+        if self.backend == "ssh2" and SSH2Session is None:
+            logger.warning("ssh2-python is not installed, fall back to paramiko")
+            self.backend = "paramiko"
 
     def _connect(self):
         """SSH command execution connection"""
@@ -71,17 +98,124 @@ class SSHConnect:
         sftp = paramiko.SFTPClient.from_transport(transport)
         return sftp, transport
 
+    def ssh2_connect(self):
+        """SSH command execution connection by the libssh2 backend"""
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        session = SSH2Session()
+        session.handshake(sock)
+        if self.pwd:
+            session.userauth_password(self.user, self.pwd)
+        elif self.rsa:
+            session.userauth_publickey_fromfile(self.user, self.rsa)
+        else:
+            sock.close()
+            raise ConnectionError(self.err)
+        return session, sock
+
+    def _key_lock(self):
+        """Return the lock for the connect and close of this server"""
+        with self._pool_lock:
+            return self._pool_locks.setdefault(
+                (self.host, self.port, self.user), threading.Lock()
+            )
+
+    def _persistent_connect(self):
+        """Reuse the SSH connection while its transport is active, the
+        connection is shared by all the instances for the same server"""
+        key = (self.host, self.port, self.user)
+        # a slow or dead server only blocks the connects to itself
+        with self._key_lock():
+            with self._pool_lock:
+                client = self._pool.get(key)
+            transport = client.get_transport() if client else None
+            if transport is None or not transport.is_active():
+                if client:
+                    client.close()
+                client = self._connect()
+                # keep the idle connection from being dropped by NAT/firewalls
+                client.get_transport().set_keepalive(30)
+            with self._pool_lock:
+                if self._client is None:
+                    self._pool_users[key] = self._pool_users.get(key, 0) + 1
+                self._client = self._pool[key] = client
+        return client
+
+    def _persistent_ssh2_connect(self):
+        """Reuse the libssh2 session until it is closed"""
+        if self._ssh2 is None:
+            self._ssh2 = self.ssh2_connect()
+        return self._ssh2[0]
+
+    def close(self):
+        """Close the persistent SSH connections, the pooled connection is
+        only closed once no other instance uses it"""
+        if self._client:
+            key = (self.host, self.port, self.user)
+            with self._key_lock():
+                with self._pool_lock:
+                    users = self._pool_users.pop(key, 1) - 1
+                    if users:
+                        self._pool_users[key] = users
+                    client = None if users else self._pool.pop(key, None)
+                if client:
+                    client.close()
+            self._client = None
+        self._close_ssh2()
+
+    def _close_ssh2(self):
+        """Close the libssh2 session, which may already be dropped"""
+        if self._ssh2:
+            session, sock = self._ssh2
+            self._ssh2 = None
+            try:
+                session.disconnect()
+            except Exception:
+                pass
+            finally:
+                sock.close()
+
+    def _exec_paramiko(self, cmd):
+        """Executes SSH command by paramiko, return code, stdout and stderr"""
+        ssh = self._persistent_connect()
+        stdin, stdout, stderr = ssh.exec_command(cmd)
+        code = stdout.channel.recv_exit_status()
+        stdout, stderr = stdout.read(), stderr.read()
+        return code, stdout, stderr
+
+    def _exec_ssh2(self, cmd):
+        """Executes SSH command by ssh2-python, return code, stdout and stderr"""
+        session = self._persistent_ssh2_connect()
+        try:
+            channel = session.open_session()
+        except Exception:
+            # the cached session was dropped by the server, reconnect once
+            self._close_ssh2()
+            channel = self._persistent_ssh2_connect().open_session()
+        channel.execute(cmd)
+        stdout, stderr = b"", b""
+        size, data = channel.read()
+        while size > 0:
+            stdout += data
+            size, data = channel.read()
+        size, data = channel.read_stderr()
+        while size > 0:
+            stderr += data
+            size, data = channel.read_stderr()
+        channel.close()
+        channel.wait_closed()
+        code = channel.get_exit_status()
+        return code, stdout, stderr
+
     def runcmd(self, cmd, if_stdout=False):
         """Executes SSH command on remote hostname.
         :param str cmd: The command to run
         :param str if_stdout: default to return the stderr
         """
-        ssh = self._connect()
         logger.info(">>> {}".format(cmd))
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        code = stdout.channel.recv_exit_status()
-        stdout, stderr = stdout.read(), stderr.read()
-        ssh.close()
+        if self.backend == "ssh2":
+            code, stdout, stderr = self._exec_ssh2(cmd)
+        else:
+            code, stdout, stderr = self._exec_paramiko(cmd)
         if if_stdout or not stderr:
             logger.info("<<< stdout\n{}".format(stdout.decode()))
             return code, stdout.decode()
@@ -104,6 +238,18 @@ class SSHConnect:
         sftp.put(local_file, remote_file)
         conn.close()
 
+    def write_file(self, content, remote_file):
+        """Write the content to a remote file over the persistent connection
+        :param str content: the text to write.
+        :param remote_file: a remote file path to be written.
+        """
+        sftp = self._persistent_connect().open_sftp()
+        try:
+            with sftp.open(remote_file, "w") as f:
+                f.write(content)
+        finally:
+            sftp.close()
+
     def put_dir(self, local_dir, remote_dir):
         """Upload all files from directory to a remote directory
         :param local_dir: all files from local path to be uploaded.
@@ -129,3 +275,38 @@ class SSHConnect:
                 except Exception as e:
                     logger.info(e)
         conn.close()
+
+
+def runcmd_all(hosts, cmd, user, pwd=None, rsafile=None, port=22, pool_size=10):
+    """Executes the same SSH command on several hosts concurrently, by
+    parallel-ssh when it is installed, else by a thread pool of SSHConnect.
+    :param list hosts: The hostnames or ips of the servers.
+    :param str cmd: The command to run
+    :param str user: The username to use when connecting.
+    :param str pwd: The password to use when connecting.
+    :param str rsafile: The path of the ssh private key to use when connecting.
+    :param int port: The server port to connect to, the default port is 22.
+    :param int pool_size: The max number of hosts to run at the same time.
+    :return: dict of the return code and the stdout for each host
+    """
+    if ParallelSSHClient is not None:
+        logger.info(">>> {} on {}".format(cmd, hosts))
+        client = ParallelSSHClient(
+            hosts, user=user, password=pwd, pkey=rsafile, port=port, pool_size=pool_size
+        )
+        output = client.run_command(cmd)
+        client.join(output)
+        results = {}
+        for host_output in output:
+            # the exit code is only set once the stdout is consumed
+            stdout = "\n".join(host_output.stdout)
+            results[host_output.host] = (host_output.exit_code, stdout)
+        return results
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        futures = {
+            host: executor.submit(
+                SSHConnect(host, user, pwd, rsafile, port).runcmd, cmd, True
+            )
+            for host in hosts
+        }
+        return {host: future.result() for host, future in futures.items()}
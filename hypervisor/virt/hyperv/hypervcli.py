@@ -1,9 +1,28 @@
-import json
+try:
+    import orjson as json
+except ImportError:
+    import json
+
 import re
 
 from hypervisor import logger
 from hypervisor.ssh import SSHConnect
 
+_CMD_HOST_INFO = """PowerShell ConvertTo-Json @("gwmi -namespace 'root/cimv2' Win32_ComputerSystemProduct | select *")"""
+_CMD_GUEST_INFO = "PowerShell ConvertTo-Json @(Get-VM {name})"
+_CMD_GUEST_IP = "PowerShell (Get-VMNetworkAdapter -VMName {name}).IpAddresses"
+_CMD_GUEST_UUID = (
+    "PowerShell (gwmi -Namespace Root\Virtualization\V2 "
+    "-ClassName Msvm_VirtualSystemSettingData).BiosGUID"
+)
+_CMD_VIRTUAL_SWITCH = "PowerShell ConvertTo-Json @(Get-VMSwitch)"
+_CMD_GUEST_LIST = "PowerShell Get-VM"
+_CMD_GUEST_REMOVE = "PowerShell Remove-VM {name} -force"
+_CMD_GUEST_START = "PowerShell Start-VM -Name {name}"
+_CMD_GUEST_STOP = "PowerShell Stop-VM -Name {name}"
+_CMD_GUEST_SUSPEND = "PowerShell Suspend-VM -Name {name}"
+_CMD_GUEST_RESUME = "PowerShell Resume-VM -Name {name}"
+
 
 class HypervCLI:
     def __init__(self, server, ssh_user, ssh_pwd):
@@ -30,6 +49,19 @@ class HypervCLI:
         if ret == 0 and stdout is not None:
             return json.loads(stdout)
 
+    def _ps_json(self, cmd, first=True):
+        """
+        Run the PowerShell command and convert its json output
+        :param cmd: the PowerShell command with ConvertTo-Json output
+        :param first: only return the first object of the list
+        :return: the first object, or the list after json.loads
+        """
+        ret, output = self.ssh.runcmd(cmd)
+        data = self._format(ret, output)
+        if first and data:
+            return data[0]
+        return data
+
     def guest_search(self, guest_name):
         """
         Search the specific guest, return the expected attributes
@@ -47,9 +79,7 @@ class HypervCLI:
         Get ip, hostname, version cpu and uuid for hyperv host
         :return: a dict
         """
-        cmd = """PowerShell ConvertTo-Json @("gwmi -namespace 'root/cimv2' Win32_ComputerSystemProduct | select *")"""
-        ret, output = self.ssh.runcmd(cmd)
-        output = self._format(ret, output)[0]
+        output = self._ps_json(_CMD_HOST_INFO)
         host_info = {
             "hyperv_ip": self.server,
             "hyperv_hostname": output["PSComputerName"],
@@ -66,9 +96,7 @@ class HypervCLI:
         :return: guest attributes, exclude guest_name, guest_ip, guest_uuid ...
                  guest_state: guest_poweron:2, guest_poweroff:3, guest_Suspended:9
         """
-        cmd = f"PowerShell ConvertTo-Json @(Get-VM {guest_name})"
-        ret, output = self.ssh.runcmd(cmd)
-        output = self._format(ret, output)[0]
+        output = self._ps_json(_CMD_GUEST_INFO.format(name=guest_name))
         guest_info = {"guest_name": output["VMName"], "guest_state": output["State"]}
         if guest_uuid:
             guest_info["guest_uuid"] = self.guest_uuid()
@@ -82,8 +110,7 @@ class HypervCLI:
         :param guest_name: the guest name for hyperv guest
         :return: the ip for hyperv guest
         """
-        cmd = f"PowerShell (Get-VMNetworkAdapter -VMName {guest_name}).IpAddresses"
-        ret, output = self.ssh.runcmd(cmd)
+        ret, output = self.ssh.runcmd(_CMD_GUEST_IP.format(name=guest_name))
         return output.split()[0] if output else None
 
     def guest_uuid(self):
@@ -91,11 +118,7 @@ class HypervCLI:
         Get uuid for hyperv guest
         :return: uuid for hyperv guest
         """
-        cmd = (
-            "PowerShell (gwmi -Namespace Root\Virtualization\V2 "
-            "-ClassName Msvm_VirtualSystemSettingData).BiosGUID"
-        )
-        ret, output = self.ssh.runcmd(cmd)
+        ret, output = self.ssh.runcmd(_CMD_GUEST_UUID)
         return output.strip()
 
     def virtual_switch(self):
@@ -103,10 +126,7 @@ class HypervCLI:
         Get the name for the virtual network switch
         :return: the virtual switch name
         """
-        cmd = "PowerShell ConvertTo-Json @(Get-VMSwitch)"
-        ret, output = self.ssh.runcmd(cmd)
-        output = self._format(ret, output)[0]
-        return output["Name"]
+        return self._ps_json(_CMD_VIRTUAL_SWITCH)["Name"]
 
     def guest_image(self, guest_name, image_path):
         """
@@ -140,8 +160,7 @@ class HypervCLI:
         :param guest_name: the name for the guest
         :return: guest exists, return True, else, return False.
         """
-        cmd = "PowerShell Get-VM"
-        ret, output = self.ssh.runcmd(cmd)
+        ret, output = self.ssh.runcmd(_CMD_GUEST_LIST)
         if not ret and guest_name in output:
             logger.info(f"Succeed to find guest {guest_name }")
             return True
@@ -193,8 +212,7 @@ class HypervCLI:
         """
         if self.guest_info(guest_name)["guest_state"] != 3:
             self.guest_stop(guest_name)
-        cmd = f"PowerShell Remove-VM {guest_name} -force"
-        ret, _ = self.ssh.runcmd(cmd)
+        ret, _ = self.ssh.runcmd(_CMD_GUEST_REMOVE.format(name=guest_name))
         if not ret and not self.guest_exist(guest_name):
             logger.info("Succeeded to delete hyperv guest")
             return True
@@ -208,8 +226,7 @@ class HypervCLI:
         :param guest_name: the virtual machines you want to power on.
         :return: power on successfully, return True, else, return False.
         """
-        cmd = f"PowerShell Start-VM -Name {guest_name}"
-        ret, _ = self.ssh.runcmd(cmd)
+        ret, _ = self.ssh.runcmd(_CMD_GUEST_START.format(name=guest_name))
         if not ret and self.guest_info(guest_name)["guest_state"] == 2:
             logger.info("Succeeded to start hyperv guest")
             return True
@@ -223,8 +240,7 @@ class HypervCLI:
         :param guest_name: the virtual machines you want to power off.
         :return: stop successfully, return True, else, return False.
         """
-        cmd = f"PowerShell Stop-VM -Name {guest_name}"
-        ret, _ = self.ssh.runcmd(cmd)
+        ret, _ = self.ssh.runcmd(_CMD_GUEST_STOP.format(name=guest_name))
         if not ret and self.guest_info(guest_name)["guest_state"] == 3:
             logger.info("Succeeded to stop hyperv guest")
             return True
@@ -238,8 +254,7 @@ class HypervCLI:
         :param guest_name: the virtual machines you want to suspend.
         :return: suspend successfully, return True, else, return False.
         """
-        cmd = f"PowerShell Suspend-VM -Name {guest_name}"
-        ret, _ = self.ssh.runcmd(cmd)
+        ret, _ = self.ssh.runcmd(_CMD_GUEST_SUSPEND.format(name=guest_name))
         if not ret and self.guest_info(guest_name)["guest_state"] == 9:
             logger.info("Succeeded to suspend hyperv guest")
             return True
@@ -253,8 +268,7 @@ class HypervCLI:
         :param guest_name: the virtual machines you want to resume.
         :return: resume successfully, return True, else, return False.
         """
-        cmd = f"PowerShell Resume-VM -Name {guest_name}"
-        ret, _ = self.ssh.runcmd(cmd)
+        ret, _ = self.ssh.runcmd(_CMD_GUEST_RESUME.format(name=guest_name))
         if not ret and self.guest_info(guest_name)["guest_state"] == 2:
             logger.info("Succeeded to resume hyperv guest")
             return True
@@ -1,14 +1,36 @@
-import json
-import math
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 import ssl
+import threading
+import time
 import urllib3
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from hypervisor import FailException
 from hypervisor import logger
-from six import PY3
+from urllib3.util.retry import Retry
 from urllib3.util.timeout import Timeout
 
 _TIMEOUT = 60
+_POOL_MAXSIZE = 10
+_PAGE_LIMIT = 500
+_CACHE_TTL = 5
+_ETAG_CACHE_SIZE = 128
+_DEBUG_BODY_LIMIT = 2048
 
 
 class KubevirtApi:
@@ -22,29 +44,65 @@ class KubevirtApi:
         :param internal_debug: detail log of the rest calls.
         """
         self._pool_manager = urllib3.PoolManager(
-            num_pools=4, maxsize=4, cert_reqs=ssl.CERT_NONE
+            num_pools=4,
+            maxsize=_POOL_MAXSIZE,
+            # only the reads are retried, the power state PUTs are not replayed
+            retries=Retry(
+                total=3, backoff_factor=0.1, allowed_methods=frozenset({"GET"})
+            ),
+            cert_reqs=ssl.CERT_NONE,
         )
         self.endpoint = endpoint
         self.token = f"Bearer {token}"
         self.internal_debug = internal_debug
+        self._api_version = None
+        self._list_cache = {}
+        self._list_lock = threading.Lock()
+        self._etags = OrderedDict()
+        self._etag_lock = threading.Lock()
 
     def _kubevirt_version(self):
         """
-        Return the kubevirt api version
+        Return the kubevirt api version, the preferred version is stable
+        for the lifetime of the server, so it is only requested once.
         :return: Kubevirt api version
         """
-        versions = self._request("/apis/kubevirt.io")
-        return versions["preferredVersion"]["version"]
+        if self._api_version is None:
+            versions = self._request("/apis/kubevirt.io")
+            self._api_version = versions["preferredVersion"]["version"]
+        return self._api_version
 
-    def _request(self, path, method="GET", field=None):
+    def invalidate_version_cache(self):
+        """
+        Drop the cached kubevirt api version, the next request will ask
+        the server again, e.g. after the kubevirt server is upgraded.
+        """
+        self._api_version = None
+
+    def _request(self, path, method="GET", field=None, raw=False, stream=False):
         """
         Send a request to the server.
         :param path: path for the url
+        :param raw: return the response body without json parsing
+        :param stream: return the response without preloading the body, the
+        caller reads it as a file object and must call release_conn()
         :return: return data for the result
         """
         header_params = {}
         header_params["Authorization"] = self.token
         url = self.endpoint + path
+        conditional = method == "GET" and not raw and not stream
+        # the continue tokens are used once, their responses are not kept
+        conditional = conditional and "continue" not in (field or {})
+        etag_key = (url, tuple(sorted((field or {}).items())))
+        cached = None
+        if conditional:
+            with self._etag_lock:
+                cached = self._etags.get(etag_key)
+                if cached:
+                    self._etags.move_to_end(etag_key)
+        if cached:
+            header_params["If-None-Match"] = cached[0]
 
         try:
             timeout = Timeout(connect=_TIMEOUT, read=_TIMEOUT)
@@ -52,71 +110,213 @@ class KubevirtApi:
                 method,
                 url,
                 fields=field,
-                preload_content=True,
+                preload_content=not stream,
                 headers=header_params,
                 timeout=timeout,
             )
             if self.internal_debug:
-                logger.debug(f"{method} method The request url sent: {url}")
-                logger.debug(f"Response status: {r.status}")
+                logger.debug("%s method The request url sent: %s", method, url)
+                logger.debug("Response status: %s", r.status)
 
         except urllib3.exceptions.SSLError as e:
             msg = f"{type(e).__name__}\n{str(e)}"
             raise FailException(msg)
 
-        if PY3:
-            data = r.data.decode("utf8")
-        else:
-            data = r.data
-        if self.internal_debug:
-            logger.debug(f"Response: {data}")
-
+        if r.status == 304 and cached:
+            return cached[1]
         if not 200 <= r.status <= 299 and not r.status == 202:
             raise FailException(f"Error: {r.data}")
 
+        if stream:
+            return r
+        if self.internal_debug:
+            logger.debug(
+                "Response: %s",
+                r.data[:_DEBUG_BODY_LIMIT].decode("utf8", errors="replace"),
+            )
+
+        if raw or not r.data:
+            return r.data
         try:
-            data = json.loads(data)
+            data = json.loads(r.data)
         except ValueError:
             data = r.data
+        etag = r.headers.get("ETag")
+        if conditional and etag:
+            with self._etag_lock:
+                self._etags[etag_key] = (etag, data)
+                self._etags.move_to_end(etag_key)
+                if len(self._etags) > _ETAG_CACHE_SIZE:
+                    self._etags.popitem(last=False)
         return data
 
-    def get_nodes(self):
+    def clear_cache(self):
+        """
+        Drop the cached list results, called after any state change.
+        """
+        with self._list_lock:
+            self._list_cache.clear()
+
+    def _request_list(self, path, field_selector=None, limit=_PAGE_LIMIT):
+        """
+        Send the list request page by page, following the continue token
+        returned by the server, and merge the items of all the pages.
+        The result is cached for _CACHE_TTL seconds, the expired results
+        are evicted when a new one is cached.
+        :param path: path for the url
+        :param field_selector: the fieldSelector to filter the objects on the server
+        :param limit: the max number of objects for each page
+        :return: the list data with the items of all the pages
+        """
+        key = (path, field_selector)
+        with self._list_lock:
+            cached = self._list_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        fields = {"limit": limit}
+        if field_selector:
+            fields["fieldSelector"] = field_selector
+        page = self._request(path, field=fields)
+        # copy the first page, it may be kept as the etag cached response
+        data = dict(page, items=list(page["items"]))
+        while page.get("metadata", {}).get("continue"):
+            fields["continue"] = page["metadata"]["continue"]
+            page = self._request(path, field=fields)
+            data["items"].extend(page["items"])
+            data["metadata"] = page["metadata"]
+        index = {item["metadata"]["name"]: item for item in data["items"]}
+        now = time.monotonic()
+        with self._list_lock:
+            # drop the expired lists, one is added for each fieldSelector
+            for expired in [k for k, v in self._list_cache.items() if v[0] <= now]:
+                del self._list_cache[expired]
+            self._list_cache[key] = (now + _CACHE_TTL, data, index)
+        return data
+
+    def _items_by_name(self, data):
+        """
+        Return the items of the list data indexed by the metadata name,
+        reuse the index built when the list was cached.
+        :param data: the list data returned by _request_list
+        :return: dict of the items with the name as key
+        """
+        with self._list_lock:
+            entries = list(self._list_cache.values())
+        for _, cached, index in entries:
+            if cached is data:
+                return index
+        return {item["metadata"]["name"]: item for item in data["items"]}
+
+    def _request_many(self, paths, field_selectors=None):
+        """
+        Send the independent list requests concurrently by _request_list,
+        the connections are shared by the thread-safe pool manager.
+        :param paths: list of the paths for the urls
+        :param field_selectors: the fieldSelector for each path, default to None
+        :return: list of the list data, in the same order as the paths
+        """
+        if not paths:
+            return []
+        field_selectors = field_selectors or [None] * len(paths)
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            return list(executor.map(self._request_list, paths, field_selectors))
+
+    def get_nodes(self, field_selector=None):
         """
         Get the params for the nodes
+        :param field_selector: the fieldSelector to filter the nodes
         :return: the params for the nodes
         """
-        return self._request("/api/v1/nodes")
+        return self._request_list("/api/v1/nodes", field_selector)
 
-    def get_vminst(self):
+    def get_vminst(self, field_selector=None):
         """
         Returns the params for the virtual manager instances by
         GET /apis/kubevirt.io/v1/virtualmachineinstances
+        :param field_selector: the fieldSelector to filter the instances
         :return: the params for the virtual manager instances
         """
         path = (
             "/apis/kubevirt.io/" + self._kubevirt_version() + "/virtualmachineinstances"
         )
-        return self._request(path)
+        return self._request_list(path, field_selector)
 
-    def get_vms(self):
+    def get_vms(self, field_selector=None):
         """
         Returns the params for the virtual managers by
         GET /apis/kubevirt.io/v1/virtualmachines
+        :param field_selector: the fieldSelector to filter the virtual machines
         :return:
         """
         path = "/apis/kubevirt.io/" + self._kubevirt_version() + "/virtualmachines"
-        return self._request(path)
+        return self._request_list(path, field_selector)
+
+    def _lazy_names(self, path, limit=_PAGE_LIMIT):
+        """
+        Return the metadata names of the list by parsing the raw pages with
+        simdjson, only the name of each item is materialized.
+        :param path: path for the url
+        :param limit: the max number of objects for each page
+        :return: list of the names
+        """
+        parser = simdjson.Parser()
+        names = []
+        fields = {"limit": limit}
+        while True:
+            doc = parser.parse(self._request(path, field=fields, raw=True))
+            names.extend(str(item["metadata"]["name"]) for item in doc["items"])
+            token = doc["metadata"].get("continue")
+            token = str(token) if token else None
+            # the parser can only be reused once the document is released
+            del doc
+            if not token:
+                return names
+            fields["continue"] = token
+
+    def _stream_names(self, path, limit=_PAGE_LIMIT):
+        """
+        Return the metadata names of the list by parsing the pages with
+        ijson while they are read from the socket, no item is materialized.
+        :param path: path for the url
+        :param limit: the max number of objects for each page
+        :return: list of the names
+        """
+        names = []
+        fields = {"limit": limit}
+        while True:
+            token = None
+            r = self._request(path, field=fields, stream=True)
+            try:
+                for prefix, event, value in ijson.parse(r):
+                    if prefix == "items.item.metadata.name":
+                        names.append(value)
+                    elif prefix == "metadata.continue":
+                        token = value
+            finally:
+                r.release_conn()
+            if not token:
+                return names
+            fields["continue"] = token
 
     def get_nodes_list(self):
         """
         Returns the list for the node name.
         :return: list of node's name.
         """
-        hosts = []
-        nodes = self.get_nodes()
-        for node in nodes["items"]:
-            name = node["metadata"]["name"]
-            hosts.append(name)
+        path = "/api/v1/nodes"
+        with self._list_lock:
+            cached = self._list_cache.get((path, None))
+        fresh = cached and cached[0] > time.monotonic()
+        if simdjson is not None and not fresh:
+            hosts = self._lazy_names(path)
+        elif ijson is not None and not fresh:
+            hosts = self._stream_names(path)
+        else:
+            hosts = []
+            nodes = self.get_nodes()
+            for node in nodes["items"]:
+                name = node["metadata"]["name"]
+                hosts.append(name)
         logger.debug(f"node list: {hosts}")
         return hosts
 
@@ -127,42 +327,53 @@ class KubevirtApi:
         :return: the cpu after the convert
         """
         if cpu.endswith("m"):
-            cpu = int(math.floor(int(cpu[:-1]) / 1000))
+            return str(int(cpu[:-1]) // 1000)
         return str(cpu)
 
-    def get_host_info(self, node_name):
+    def get_host_info(self, node_name, nodes=None):
         """
         Returns the messages for the host.
         :param node_name: the name for the specific node
+        :param nodes: the nodes already fetched by get_nodes, fetch them if None
         :return: return the host info include the host uuid, cpu, version and hostname
         """
-        nodes = self.get_nodes()
+        if nodes is None:
+            nodes = self.get_nodes(f"metadata.name={node_name}")
         host_info = {}
-        for node in nodes["items"]:
-            if node["metadata"]["name"] == node_name:
-                host_info["uuid"] = node["status"]["nodeInfo"]["machineID"]
-                host_info["cpu"] = self.parse_cpu(node["status"]["allocatable"]["cpu"])
-                host_info["version"] = node["status"]["nodeInfo"]["kubeletVersion"]
-                for addr in node["status"]["addresses"]:
-                    if addr["type"] == "Hostname":
-                        host_info["hostname"] = addr["address"]
+        node = self._items_by_name(nodes).get(node_name)
+        if node:
+            host_info["uuid"] = node["status"]["nodeInfo"]["machineID"]
+            host_info["cpu"] = self.parse_cpu(node["status"]["allocatable"]["cpu"])
+            host_info["version"] = node["status"]["nodeInfo"]["kubeletVersion"]
+            hostname = next(
+                (
+                    addr["address"]
+                    for addr in node["status"]["addresses"]
+                    if addr["type"] == "Hostname"
+                ),
+                None,
+            )
+            if hostname is not None:
+                host_info["hostname"] = hostname
         logger.debug(f"host info: {host_info}")
         return host_info
 
-    def get_vm_info(self, guest_name):
+    def get_vm_info(self, guest_name, vms_inst=None):
         """
         Returns the messages for the virtual manager.
         :param guest_name: the guest name for the specific guest
+        :param vms_inst: the instances already fetched by get_vminst, fetch them if None
         :return: the guest messages for the virtual manger, include guest uuid, state,
         nodename, etc.
         """
         guest_info = {}
-        vms_inst = self.get_vminst()
-        for vm_inst in vms_inst["items"]:
-            if vm_inst["metadata"]["name"] == guest_name:
-                guest_info["guest_uuid"] = vm_inst["spec"]["domain"]["firmware"]["uuid"]
-                guest_info["hostname"] = vm_inst["status"]["nodeName"]
-                guest_info["guest_state"] = vm_inst["status"]["phase"]
+        if vms_inst is None:
+            vms_inst = self.get_vminst(f"metadata.name={guest_name}")
+        vm_inst = self._items_by_name(vms_inst).get(guest_name)
+        if vm_inst:
+            guest_info["guest_uuid"] = vm_inst["spec"]["domain"]["firmware"]["uuid"]
+            guest_info["hostname"] = vm_inst["status"]["nodeName"]
+            guest_info["guest_state"] = vm_inst["status"]["phase"]
         logger.debug(f"vm info: {guest_info}")
         return guest_info
 
@@ -173,10 +384,9 @@ class KubevirtApi:
         :return:
         """
         namespace = ""
-        vms = self.get_vms()
-        for vm in vms["items"]:
-            if vm["metadata"]["name"] == guest_name:
-                namespace = vm["metadata"]["namespace"]
+        vm = self._items_by_name(self.get_vms()).get(guest_name)
+        if vm:
+            namespace = vm["metadata"]["namespace"]
         return namespace
 
     def guest_search(self, guest_name, guest_port):
@@ -189,12 +399,57 @@ class KubevirtApi:
             Vm info (dict): guest attributes, include guest_name, guest_uuid, guest_state,
             uuid, hostname, version, cpu, etc.
         """
-        guest_msgs = {}
-        guest_msgs.update(self.get_vm_info(guest_name))
-        if "hostname" in guest_msgs:
-            guest_msgs["guest_ip"] = f"{guest_msgs['hostname']}:{guest_port}"
-            guest_msgs.update(self.get_host_info(guest_msgs["hostname"]))
-        return guest_msgs
+        return self.guests_search_bulk([guest_name], guest_port)[guest_name]
+
+    def guests_search_bulk(self, guest_names, guest_port):
+        """
+        Search the guests with one fetch of the VM instances and nodes,
+        return the expected attributes of each guest
+        Args:
+            guest_names (list) : names for the guests
+            guest_port (int) : port for the guests
+        Returns:
+            Vms info (dict): guest attributes as guest_search returns,
+            with the guest name as key.
+        """
+        selector = None
+        if len(guest_names) == 1:
+            selector = f"metadata.name={guest_names[0]}"
+        path = (
+            "/apis/kubevirt.io/" + self._kubevirt_version() + "/virtualmachineinstances"
+        )
+        vms_inst, nodes = self._request_many([path, "/api/v1/nodes"], [selector, None])
+        guests_msgs = {}
+        for guest_name in guest_names:
+            guest_msgs = self.get_vm_info(guest_name, vms_inst)
+            if "hostname" in guest_msgs:
+                guest_msgs["guest_ip"] = f"{guest_msgs['hostname']}:{guest_port}"
+                guest_msgs.update(self.get_host_info(guest_msgs["hostname"], nodes))
+            guests_msgs[guest_name] = guest_msgs
+        return guests_msgs
+
+    def guests_search_many(self, guest_names, guest_port, workers=_POOL_MAXSIZE):
+        """
+        Search the guests concurrently, one guest_search for each guest,
+        the workers share the keep-alive connections of the pool manager.
+        Args:
+            guest_names (list) : names for the guests
+            guest_port (int) : port for the guests
+            workers (int) : max number of concurrent searches
+        Returns:
+            Vms info (list): guest attributes as guest_search returns,
+            in the same order as the guest names.
+        """
+        # cache the api version and the node list shared by all the searches,
+        # else every worker fetches them at the same time
+        self._kubevirt_version()
+        self.get_nodes()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(
+                executor.map(
+                    lambda name: self.guest_search(name, guest_port), guest_names
+                )
+            )
 
     def guest_set_power_state(self, guest_name, state):
         """
@@ -210,6 +465,7 @@ class KubevirtApi:
             + self._kubevirt_version()
             + f"/namespaces/{namespace}/virtualmachines/{guest_name}/{state}"
         )
+        self.clear_cache()
         return self._request(path, "PUT")
 
     def guest_start(self, guest_name):
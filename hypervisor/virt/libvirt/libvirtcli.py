@@ -1,11 +1,76 @@
 import re
 import time
-import os
 import random
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 from hypervisor import logger
 from hypervisor.ssh import SSHConnect
 
+_MARKER = "<<hypervisor-builder>>"
+_GUEST_NAMES_TTL = 5
+_IP_RE = re.compile(r"(?:\d{1,3}\.){3}\d{1,3}")
+_CURL_RETRY = "--retry 5 --retry-delay 5 --retry-max-time 600"
+
+
+def _parse_host_uuid(output):
+    """Parse the host uuid from the 'virsh capabilities' uuid lines"""
+    _, found, rest = output.rpartition("<uuid>")
+    uuid, closed, _ = rest.partition("</uuid>")
+    return uuid.strip() if found and closed else None
+
+
+def _parse_host_version(output):
+    """Parse the hypervisor version from the 'virsh version' output"""
+    return output.split("QEMU")[-1].strip() if "QEMU" in output else None
+
+
+def _parse_host_cpu(output):
+    """Parse the cpu sockets from the 'virsh nodeinfo' output"""
+    return output.split(":")[1].strip() if "CPU socket(s)" in output else None
+
+
+def _parse_mac(output):
+    """Parse the mac of the first interface from the 'virsh domiflist' output"""
+    # the interface rows follow the header and the dash separator line
+    rows = [line.split() for line in output.splitlines()[2:] if line.strip()]
+    if rows and rows[0][-1].count(":") == 5:
+        return rows[0][-1]
+    return None
+
+
+def _parse_lease_ip(output, mac_addr):
+    """Parse the ipv4 address of the mac from the domifaddr/dhcp-leases rows"""
+    for line in output.lower().splitlines():
+        tokens = line.split()
+        if mac_addr.lower() in tokens and "ipv4" in tokens:
+            return tokens[tokens.index("ipv4") + 1].partition("/")[0]
+    return None
+
+
+def _parse_xml_mac(output):
+    """Parse the mac of the first interface from the 'virsh dumpxml' output"""
+    _, found, rest = output.partition("<mac address=")
+    return rest[1:18] if found and rest[1:18].count(":") == 5 else None
+
+
+def _sed_escape(value):
+    """Escape the value for the replacement of a 's|...|...|' sed expression"""
+    return re.sub(r"([\\|&])", r"\\\1", value)
+
+
+def _parse_nmap_ip(output, mac_addr):
+    """Parse the ip of the mac from the 'nmap -sP' output"""
+    guest_ip = None
+    for line in output.splitlines():
+        if line.startswith("Nmap scan report for"):
+            found = _IP_RE.search(line)
+            guest_ip = found.group() if found else None
+        elif mac_addr.lower() in line.lower():
+            return guest_ip
+    return None
+
 
 class LibvirtCLI:
     def __init__(self, server, ssh_user, ssh_passwd):
@@ -21,22 +86,93 @@ class LibvirtCLI:
         self.ssh_user = ssh_user
         self.ssh_passwd = ssh_passwd
         self.ssh = SSHConnect(self.server, user=self.ssh_user, pwd=self.ssh_passwd)
+        self._host_uuid = None
+        self._host_version = None
+        self._host_cpu = None
+        self._mac_by_guest = {}
+        self._rhel_version = None
+        self._guest_names = (0, set())
+        self._virtlogd_ready = False
+        self._gateways = {}
+        self._image_ready = set()
+
+    def __del__(self):
+        self.ssh.close()
+
+    def invalidate(self, guest_name):
+        """
+        Drop the cached values of the guest, call it after the guest
+        is reconfigured or deleted.
+        :param guest_name: name for the specific guest
+        """
+        self._mac_by_guest.pop(guest_name, None)
+        self._guest_names = (0, set())
+
+    def _run_sections(self, cmds):
+        """
+        Run several commands in one ssh session, the output of each
+        command follows its own marker line
+        :param cmds: dict of the command for each key
+        :return: dict of the stripped output for each key
+        """
+        cmd = "; ".join(
+            f"echo '{_MARKER}{key}'; {value}" for key, value in cmds.items()
+        )
+        ret, output = self.ssh.runcmd(cmd, if_stdout=True)
+        sections = {}
+        for chunk in output.split(_MARKER)[1:]:
+            key, _, value = chunk.partition("\n")
+            sections[key] = value.strip()
+        return sections
+
+    def _host_cmds(self):
+        """
+        The commands for the host info which is not cached yet
+        :return: dict of the command for each key
+        """
+        cmds = {}
+        if not self._host_uuid:
+            cmds["capabilities"] = "virsh capabilities |grep '<uuid>'"
+        if not self._host_version:
+            cmds["version"] = "virsh version |grep 'Running hypervisor'"
+        if not self._host_cpu:
+            cmds["nodeinfo"] = "virsh nodeinfo |grep 'CPU socket(s)'"
+        return cmds
+
+    def _cache_host_info(self, sections):
+        """
+        Parse the host info from the command sections into the cache
+        :param sections: dict of the output for each command
+        """
+        if "capabilities" in sections:
+            self._host_uuid = _parse_host_uuid(sections["capabilities"])
+        if "version" in sections:
+            self._host_version = _parse_host_version(sections["version"])
+        if "nodeinfo" in sections:
+            self._host_cpu = _parse_host_cpu(sections["nodeinfo"])
+
+    def _host_info(self):
+        """
+        Get the uuid, version and cpu sockets for libvirt host in one
+        ssh session, they never change so they are cached
+        """
+        cmds = self._host_cmds()
+        if cmds:
+            self._cache_host_info(self._run_sections(cmds))
 
     def host_uuid(self):
         """
         Get uuid for libvirt host
         :return: uuid for libvirt host
         """
-        cmd = "virsh capabilities |grep '<uuid>'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and "uuid" in output:
-            uuid = re.findall(r"<uuid>(.*?)</uuid>", output)[-1].strip()
+        self._host_info()
+        if self._host_uuid:
             logger.info(
                 "Succeeded to get libvirt host({0}) uuid is: {1}".format(
-                    self.server, uuid
+                    self.server, self._host_uuid
                 )
             )
-            return uuid
+            return self._host_uuid
         else:
             logger.error("Failed to check libvirt host({0}) uuid".format(self.server))
             return None
@@ -46,63 +182,99 @@ class LibvirtCLI:
         Get version for libvirt host
         :return: version for libvirt host
         """
-        cmd = "virsh version |grep 'Running hypervisor'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and "QEMU" in output:
-            version = output.split("QEMU")[-1].strip()
+        self._host_info()
+        if self._host_version is not None:
             logger.info(
                 "Succeeded to get libvirt host({0}) version is: {1}".format(
-                    self.server, version
+                    self.server, self._host_version
                 )
             )
-            return version
+            return self._host_version
         else:
             logger.error("Failed to get libvirt host({0}) version".format(self.server))
             return None
 
     def host_cpu(self):
         """
-        Get version for libvirt host
-        :return: version for libvirt host
+        Get cpu sockets for libvirt host
+        :return: cpu sockets for libvirt host
         """
-        cmd = "virsh nodeinfo  |grep 'CPU socket(s)'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and "CPU socket(s)" in output:
-            cpu = output.split(":")[1].strip()
+        self._host_info()
+        if self._host_cpu is not None:
             logger.info(
-                "Succeeded to get libvirt host({0}) cpu : {1}".format(self.server, cpu)
+                "Succeeded to get libvirt host({0}) cpu : {1}".format(
+                    self.server, self._host_cpu
+                )
             )
-            return cpu
+            return self._host_cpu
         else:
             logger.error("Failed to get libvirt host({0}) cpu".format(self.server))
             return None
 
+    def _batched_info(self, guest_name):
+        """
+        Run the virsh commands for the host and guest info in one ssh
+        session, the output of each command follows its own marker line,
+        the host commands are skipped once their values are cached
+        :param guest_name: name for the specific guest
+        :return: dict of the stripped output for each command
+        """
+        cmds = self._host_cmds()
+        cmds.update(
+            {
+                "domuuid": f"virsh domuuid {shlex.quote(guest_name)}",
+                "domstate": f"virsh domstate {shlex.quote(guest_name)}",
+                "domiflist": f"virsh domiflist {shlex.quote(guest_name)}",
+            }
+        )
+        return self._run_sections(cmds)
+
     def guest_search(self, guest_name):
         """
         Search the specific guest, return the expected attributes
         :param guest_name: name for the specific guest
         :return: guest attributes, exclude guest_name, guest_ip, guest_uuid ...
         """
+        info = self._batched_info(guest_name)
+        self._cache_host_info(info)
+        mac_addr = _parse_mac(info.get("domiflist", ""))
+        if mac_addr:
+            self._mac_by_guest[guest_name] = mac_addr
         guest_msgs = {
             "guest_name": guest_name,
             "guest_ip": self.guest_ip(guest_name),
-            "guest_uuid": self.guest_uuid(guest_name),
-            "guest_state": self.guest_status(guest_name),
-            "host_uuid": self.host_uuid(),
-            "host_version": self.host_version(),
-            "host_cpu": self.host_cpu(),
+            "guest_uuid": info.get("domuuid") or None,
+            "guest_state": info.get("domstate") or "false",
+            "host_uuid": self._host_uuid,
+            "host_version": self._host_version,
+            "host_cpu": self._host_cpu,
         }
+        logger.info(f"libvirt({self.server}) guest info: {guest_msgs}")
         return guest_msgs
 
+    def _guest_name_set(self):
+        """
+        Get the names of all the libvirt guests, the set is cached for
+        a few seconds so that checking many guests lists them only once
+        :return: set of the guest names
+        """
+        expiry, names = self._guest_names
+        if time.monotonic() < expiry:
+            return names
+        ret, output = self.ssh.runcmd("virsh list --all --name")
+        if ret:
+            return set()
+        names = set(output.split())
+        self._guest_names = (time.monotonic() + _GUEST_NAMES_TTL, names)
+        return names
+
     def guest_exist(self, guest_name):
         """
         Check if the esx guest exists
         :param guest_name: the name for the guest
         :return: guest exists, return True, else, return False.
         """
-        cmd = "virsh  dominfo {0} | grep '^Name'".format(guest_name)
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and guest_name in output:
+        if guest_name in self._guest_name_set():
             logger.info(
                 "libvirt({0}) guest {1} is exist".format(self.server, guest_name)
             )
@@ -119,10 +291,10 @@ class LibvirtCLI:
         :param guest_name: the guest name for libvirt guest
         :return: uuid for libvirt guest
         """
-        cmd = "virsh domuuid {0}".format(guest_name)
+        cmd = f"virsh domuuid {shlex.quote(guest_name)}"
         ret, output = self.ssh.runcmd(cmd)
-        if not ret and output is not None:
-            uuid = output.strip()
+        uuid = output.strip()
+        if not ret and uuid:
             logger.info(
                 "Succeeded to get libvirt({0}) guest uuid: {1}".format(
                     self.server, uuid
@@ -139,35 +311,63 @@ class LibvirtCLI:
         :param guest_name: name for the specific guest
         :return: the status for the guest
         """
-        cmd = "virsh  domstate {0}".format(guest_name)
-        ret, output = self.ssh.runcmd(
-            cmd,
-        )
-        if not ret and output.strip() is not None and output.strip() != "":
-            status = output.strip()
+        cmd = f"virsh domstate {shlex.quote(guest_name)}"
+        ret, output = self.ssh.runcmd(cmd)
+        status = output.strip()
+        if not ret and status:
             logger.info("libvirt({0}) guest status is: {1}".format(self.server, status))
             return status
         else:
             logger.info("Failed to check libvirt({0}) guest status".format(self.server))
             return "false"
 
+    def _run_with_status(self, cmd, guest_name, target, timeout=15):
+        """
+        Run the command and poll the status for the guest in one ssh
+        session, the polling only runs if the command succeeded and stops
+        as soon as the guest reaches the target status
+        :param cmd: the command to run, None to only poll the status
+        :param guest_name: name for the specific guest
+        :param target: the expected status for the guest
+        :param timeout: max seconds to poll the status
+        :return: the return code and the last status for the guest
+        """
+        poll = (
+            f"for i in $(seq {timeout * 5}); do "
+            f"s=$(virsh domstate {shlex.quote(guest_name)}); "
+            f'[ "$s" = \'{target}\' ] && break; sleep 0.2; done; echo "$s"'
+        )
+        cmd = f"{cmd} && {poll}" if cmd else poll
+        ret, output = self.ssh.runcmd(cmd, if_stdout=True)
+        lines = output.strip().splitlines()
+        status = lines[-1].strip() if lines else ""
+        logger.info("libvirt({0}) guest status is: {1}".format(self.server, status))
+        return ret, status
+
     def guest_mac(self, guest_name):
         """
         Get the mac address for the guest
         :param guest_name: name for the specific guest
         :return: the mac address for the guest
         """
-        cmd = "virsh dumpxml {0} | grep 'mac address'".format(guest_name)
+        if guest_name in self._mac_by_guest:
+            return self._mac_by_guest[guest_name]
+        cmd = f"virsh domiflist {shlex.quote(guest_name)}"
         ret, output = self.ssh.runcmd(cmd)
-        if not ret:
-            mac_addr = re.findall(r"mac address='(.*?)'", output)[0]
-            if mac_addr is not None or mac_addr != "":
-                logger.info(
-                    "Succeeded to get libvirt({0}) guest mac: {1}".format(
-                        self.server, mac_addr
-                    )
+        mac_addr = _parse_mac(output)
+        if not ret and not mac_addr:
+            # domiflist has no row for the interfaces without a source
+            cmd = f"virsh dumpxml {shlex.quote(guest_name)} | grep '<mac address='"
+            ret, output = self.ssh.runcmd(cmd)
+            mac_addr = _parse_xml_mac(output)
+        if not ret and mac_addr:
+            logger.info(
+                "Succeeded to get libvirt({0}) guest mac: {1}".format(
+                    self.server, mac_addr
                 )
-                return mac_addr
+            )
+            self._mac_by_guest[guest_name] = mac_addr
+            return mac_addr
         else:
             logger.error(
                 "Failed to get libvirt({0}) guest mac address".format(self.server)
@@ -176,18 +376,29 @@ class LibvirtCLI:
 
     def guest_ip(self, guest_name):
         """
-        Get guest ip by mac
+        Get guest ip by mac, look up the libvirt dhcp leases and the guest
+        agent first, only scan the host network by nmap if they have no ip
         :param guest_name: name for the specific guest
         :return:
         """
+        guest_mac = self.guest_mac(guest_name)
+        if not guest_mac:
+            return None
+        cmd = (
+            f"virsh domifaddr {shlex.quote(guest_name)} --source lease; "
+            f"virsh domifaddr {shlex.quote(guest_name)} --source agent; "
+            f"virsh net-dhcp-leases default"
+        )
+        ret, output = self.ssh.runcmd(f"{{ {cmd}; }} 2>/dev/null", if_stdout=True)
+        guest_ip = _parse_lease_ip(output, guest_mac)
+        if guest_ip:
+            logger.info(f"Succeeded to get libvirt guest ip ({guest_ip})")
+            return guest_ip
         gateway = self.get_gateway(self.server)
-        guest_mac = self.get_guest_mac(guest_name)
-        if gateway and guest_mac:
-            option = "grep 'Nmap scan report for' | grep -Eo '([0-9]{1,3}[\.]){3}[0-9]{1,3}'| tail -1"
-            cmd = f"nmap -sP -n {gateway} | grep -i -B 2 {guest_mac} | {option}"
-            ret, output = self.ssh.runcmd(cmd, if_stdout=True)
-            if not ret and output is not None and output != "":
-                guest_ip = output.strip()
+        if gateway:
+            ret, output = self.ssh.runcmd(f"nmap -sP -n {gateway}", if_stdout=True)
+            guest_ip = _parse_nmap_ip(output, guest_mac)
+            if not ret and guest_ip:
                 logger.info(f"Succeeded to get libvirt guest ip ({guest_ip})")
                 return guest_ip
             else:
@@ -203,39 +414,17 @@ class LibvirtCLI:
         :param host_pwd: the ssh password for the libvirt host
         :return: the gateway for host
         """
-        cmd = f"ip route | grep {host_ip} | grep /"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and output is not None and output != "":
-            output = output.strip().split(" ")
-            if len(output) > 0:
-                gateway = output[0]
-                return gateway
-        else:
-            logger.error(f"Failed to get gateway({host_ip})")
-            return None
-
-    def get_guest_mac(self, guest_name):
-        """
-        Get the mac address for the guest
-        :param guest_name: name for the specific guest
-        :return: the mac address for the guest
-        """
-        cmd = "virsh dumpxml {0} | grep 'mac address'".format(guest_name)
-        ret, output = self.ssh.runcmd(cmd)
-        if ret == 0:
-            mac_addr = re.findall(r"mac address='(.*?)'", output)[0]
-            if mac_addr is not None or mac_addr != "":
-                logger.info(
-                    "Succeeded to get libvirt({0}) guest mac: {1}".format(
-                        self.server, mac_addr
-                    )
-                )
-                return mac_addr
-        else:
-            logger.error(
-                "Failed to get libvirt({0}) guest mac address".format(self.server)
-            )
-            return None
+        if host_ip in self._gateways:
+            return self._gateways[host_ip]
+        ret, output = self.ssh.runcmd("ip -o -4 route show", if_stdout=True)
+        if not ret:
+            for line in output.splitlines():
+                parts = line.split()
+                if parts and "/" in parts[0] and host_ip in line:
+                    self._gateways[host_ip] = parts[0]
+                    return parts[0]
+        logger.error(f"Failed to get gateway({host_ip})")
+        return None
 
     def guest_autostart(self, guest_name):
         """
@@ -243,7 +432,7 @@ class LibvirtCLI:
         :param guest_name: the virtual machines you want to auto start.
         :return: set up successfully, return True, else, return False.
         """
-        cmd = "virsh autostart {0}".format(guest_name)
+        cmd = f"virsh autostart {shlex.quote(guest_name)}"
         ret, output = self.ssh.runcmd(cmd)
         if not ret:
             logger.info("Succeeded to auto start libvirt({0}) guest".format(self.server))
@@ -256,15 +445,17 @@ class LibvirtCLI:
         :param guest_name: the virtual machines you want to power on.
         :return: power on successfully, return True, else, return False.
         """
-        cmd = "virsh --connect qemu:///system start {0}".format(guest_name)
+        cmd = f"virsh --connect qemu:///system start {shlex.quote(guest_name)}"
+        virtlogd = not self._virtlogd_ready
+        if virtlogd:
+            # the guest fails to start without the virtlogd socket
+            cmd = f"systemctl start virtlogd.socket 2>/dev/null; {cmd}"
         ret, output = self.ssh.runcmd(cmd)
-        if "Failed to connect socket to '/var/run/libvirt/virtlogd-sock'" in output:
-            cmd = "systemctl start virtlogd.socket"
-            self.ssh.runcmd(cmd)
-            cmd = "virsh --connect qemu:///system start {0}".format(guest_name)
-            self.ssh.runcmd(cmd)
-            time.sleep(10)
-        if self.guest_status(guest_name) == "running":
+        if virtlogd and ret == 0:
+            # the socket is started again by the next start if this one failed
+            self._virtlogd_ready = True
+        ret, status = self._run_with_status(None, guest_name, "running")
+        if not ret and status == "running":
             logger.info("Succeeded to start libvirt({0}) guest".format(self.server))
             return True
         else:
@@ -277,10 +468,9 @@ class LibvirtCLI:
         :param guest_name: the virtual machines you want to power off.
         :return: stop successfully, return True, else, return False.
         """
-        cmd = "virsh shutdown {0}".format(guest_name)
-        ret, output = self.ssh.runcmd(cmd)
-        time.sleep(5)
-        if not ret and self.guest_status(guest_name) == "shut off":
+        cmd = f"virsh shutdown {shlex.quote(guest_name)}"
+        ret, status = self._run_with_status(cmd, guest_name, "shut off")
+        if not ret and status == "shut off":
             logger.info("Succeeded to shutdown libvirt({0}) guest".format(self.server))
             return True
         else:
@@ -293,10 +483,9 @@ class LibvirtCLI:
         :param guest_name: the virtual machines you want to suspend.
         :return: suspend successfully, return True, else, return False.
         """
-        cmd = "virsh suspend {0}".format(guest_name)
-        ret, output = self.ssh.runcmd(cmd)
-        time.sleep(5)
-        if not ret and self.guest_status(guest_name) == "paused":
+        cmd = f"virsh suspend {shlex.quote(guest_name)}"
+        ret, status = self._run_with_status(cmd, guest_name, "paused")
+        if not ret and status == "paused":
             logger.info("Succeeded to pause libvirt({0}) guest".format(self.server))
             return True
         else:
@@ -309,10 +498,9 @@ class LibvirtCLI:
         :param guest_name: the virtual machines you want to resume.
         :return: resume successfully, return True, else, return False.
         """
-        cmd = "virsh resume {0}".format(guest_name)
-        ret, output = self.ssh.runcmd(cmd)
-        time.sleep(10)
-        if not ret and self.guest_status(guest_name) == "running":
+        cmd = f"virsh resume {shlex.quote(guest_name)}"
+        ret, status = self._run_with_status(cmd, guest_name, "running")
+        if not ret and status == "running":
             logger.info("Succeeded to resume libvirt({0}) guest".format(self.server))
             return True
         else:
@@ -328,13 +516,19 @@ class LibvirtCLI:
         if self.guest_exist(guest_name):
             self.guest_delete(guest_name)
         self.guest_image_download(guest_name, image_url, xml_url, image_path, xml_path)
-        for i in range(5):
-            if self.guest_exist(guest_name):
-                logger.info(f"Succeeded to add libvirt({self.server}) guest")
-                self.guest_autostart(guest_name)
-                return self.guest_start(guest_name)
+        if not self.guest_exist(guest_name):
+            # virsh define is synchronous, only wait a little for a slow host
             logger.warning("no libvirt guest found, try to search again...")
-            time.sleep(15)
+            name = shlex.quote(guest_name)
+            self.ssh.runcmd(
+                f"for i in $(seq 50); do "
+                f"virsh domstate {name} >/dev/null 2>&1 && break; sleep 0.2; done"
+            )
+            self.invalidate(guest_name)
+        if self.guest_exist(guest_name):
+            logger.info(f"Succeeded to add libvirt({self.server}) guest")
+            self.guest_autostart(guest_name)
+            return self.guest_start(guest_name)
         logger.error("Failed to create libvirt guest")
         return False
 
@@ -345,8 +539,10 @@ class LibvirtCLI:
         :return: Delete successfully, return True, else, return False
         """
         logger.info(f"Start to delete libvirt({self.server}) guest")
-        cmd = f"virsh destroy {guest_name}; virsh undefine {guest_name}"
+        name = shlex.quote(guest_name)
+        cmd = f"virsh destroy {name}; virsh undefine {name}"
         self.ssh.runcmd(cmd)
+        self.invalidate(guest_name)
         if self.guest_exist(guest_name):
             logger.error(f"Failed to delete libvirt({self.server}) guest")
             return False
@@ -366,54 +562,70 @@ class LibvirtCLI:
         """
         guest_image = f"{image_path}/{guest_name}.qcow2"
         guest_xml = f"{xml_path}/{guest_name}.xml"
-        if self.url_validation(image_url) is False:
+        image, xml, path = map(shlex.quote, (guest_image, guest_xml, image_path))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            image_valid, xml_valid = executor.map(
+                self.url_validation, [image_url, xml_url]
+            )
+        if image_valid is False:
             logger.error("image_url is not available")
             return False
-        if self.url_validation(xml_url) is False:
+        if xml_valid is False:
             logger.error("xml_url is not available")
         if self.guest_image_exist(guest_name, image_path, xml_path) is False:
-            cmd = f"rm -f {guest_xml}; rm -rf {image_path}; mkdir -p {image_path}; "\
-                  f"chmod a+rwx {image_path}"
-            self.ssh.runcmd(cmd)
-            for i in range(5):
-                cmd = f"curl -L {image_url} -o {guest_image}"
-                ret, output = self.ssh.runcmd(cmd)
-                if ret == 0:
-                    break
-                logger.warning("Failed to download libvirt image, try again...")
-            for i in range(5):
-                cmd = f"curl -L {xml_url} -o {guest_xml}"
-                ret, output = self.ssh.runcmd(cmd)
-                if ret == 0:
-                    break
-                logger.warning("Failed to download libvirt xml file, try again...")
-            cmd = f"sed -i -e 's|<name>.*</name>|<name>{guest_name}</name>|g' {guest_xml}"
-            self.ssh.runcmd(cmd)
-            cmd = f"sed -i -e 's|<source file=.*/>|<source file=\"{guest_image}\"/>|g' {guest_xml}"
+            self._image_ready.discard((guest_name, image_path, xml_path))
+            cmd = f"rm -f {xml}; rm -rf {path}; mkdir -p {path}; chmod a+rwx {path}"
             self.ssh.runcmd(cmd)
+            # download the image and the xml file in parallel, then print
+            # the exit code of each curl
+            cmd = (
+                f"curl -L {_CURL_RETRY} {shlex.quote(image_url)} -o {image} & "
+                f"P1=$!; "
+                f"curl -L {_CURL_RETRY} {shlex.quote(xml_url)} -o {xml} & "
+                f"P2=$!; "
+                f'wait $P1; R1=$?; wait $P2; R2=$?; echo "$R1 $R2"'
+            )
+            ret, output = self.ssh.runcmd(cmd, if_stdout=True)
+            codes = output.split()[-2:]
+            if codes[:1] != ["0"]:
+                logger.warning("Failed to download libvirt image")
+            if codes[1:] != ["0"]:
+                logger.warning("Failed to download libvirt xml file")
+            if codes == ["0", "0"]:
+                self._image_ready.add((guest_name, image_path, xml_path))
             guest_mac = self.randomMAC()
-            cmd = f"sed -i -e 's|<mac address=.*/>|<mac address=\"{guest_mac}\"/>|g' {guest_xml}"
-            self.ssh.runcmd(cmd)
+            exprs = [
+                f"s|<name>.*</name>|<name>{_sed_escape(guest_name)}</name>|g",
+                f's|<source file=.*/>|<source file="{_sed_escape(guest_image)}"/>|g',
+                f's|<mac address=.*/>|<mac address="{guest_mac}"/>|g',
+            ]
             if self.rhel_version() == "9":
-                cmd = f"sed -i -e 's|<graphics type=.* |<graphics type=\"vnc\" |g' {guest_xml}"
-                self.ssh.runcmd(cmd)
-        cmd = f"virsh define {guest_xml}"
+                exprs.append('s|<graphics type=.* |<graphics type="vnc" |g')
+            cmd = "sed -i " + "".join(f"-e {shlex.quote(e)} " for e in exprs)
+            self.ssh.runcmd(f"{cmd}{xml}")
+        cmd = f"virsh define {xml}"
         self.ssh.runcmd(cmd)
+        self.invalidate(guest_name)
         logger.info(f"Succeeded to download libvirt image to {self.server}")
 
     def guest_image_exist(self, guest_name, image_path, xml_path):
         """
-        Identify if the image of guest exist
+        Identify if the image of guest exist, the files downloaded or found
+        by this instance are not checked again
         :param guest_name: the name of guest
         :param image_path: the path of image
         :param xml_path: the path of xml file
         :return: if image exist, return True, else, return False
         """
-        guest_image = f"{image_path}/{guest_name}.qcow2"
-        guest_xml = f"{xml_path}/{guest_name}.xml"
-        cmd = f"ls {guest_image}; ls {guest_xml}"
-        ret, output = self.ssh.runcmd(cmd)
-        if ret == 0 and "No such file or directory" not in output:
+        key = (guest_name, image_path, xml_path)
+        if key in self._image_ready:
+            return True
+        guest_image = shlex.quote(f"{image_path}/{guest_name}.qcow2")
+        guest_xml = shlex.quote(f"{xml_path}/{guest_name}.xml")
+        cmd = f"test -f {guest_image} && test -f {guest_xml} && echo OK"
+        ret, output = self.ssh.runcmd(cmd, if_stdout=True)
+        if ret == 0 and output.strip() == "OK":
+            self._image_ready.add(key)
             logger.info(f"libvirt image and xml exist in {self.server}")
             return True
         else:
@@ -426,38 +638,37 @@ class LibvirtCLI:
         :param url: the url link
         :return: if the url is valid, return true; Else, return False
         """
-        cmd = f"if ( curl -o/dev/null -sfI '{url}' ); then echo 'true'; else echo 'false'; fi"
-        output = os.popen(cmd).read()
-        if output.strip() == "true":
-            return True
-        else:
+        cmd = ["curl", "-o", "/dev/null", "-sfI", url]
+        try:
+            ret = subprocess.run(cmd, stdout=subprocess.DEVNULL, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
             return False
+        return ret.returncode == 0
 
     def randomMAC(self):
         """
         Generate the Mac address randomly
         :return: Mac dress
         """
-        mac = [
-            0x06,
-            random.randint(0x00, 0x2F),
-            random.randint(0x00, 0x3F),
-            random.randint(0x00, 0x4F),
-            random.randint(0x00, 0x8F),
-            random.randint(0x00, 0xFF),
+        bits = random.getrandbits(40).to_bytes(5, "big")
+        mac = [0x06] + [
+            byte % (limit + 1)
+            for byte, limit in zip(bits, (0x2F, 0x3F, 0x4F, 0x8F, 0xFF))
         ]
-        return ":".join(map(lambda x: "%02x" % x, mac))
+        return "%02x:%02x:%02x:%02x:%02x:%02x" % tuple(mac)
 
     def rhel_version(self):
         """
-        Get the version of the RHEL system
+        Get the version of the RHEL system, it is cached after the first check
         :return: the version of the RHEL system
         """
+        if self._rhel_version:
+            return self._rhel_version
         cmd = "cat /etc/redhat-release"
         ret, output = self.ssh.runcmd(cmd)
-        if ret == 0 and output is not None:
-            m = re.search(r"(?<=release )\d", output)
-            rhel_ver = m.group(0)
-            return str(rhel_ver)
+        _, found, rest = output.partition("release ")
+        if ret == 0 and found and rest[:1].isdigit():
+            self._rhel_version = rest[0]
+            return self._rhel_version
         else:
             logger.error(f"Unknown rhel release: {output.strip()} ({self.server})")
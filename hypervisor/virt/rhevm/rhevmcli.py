@@ -2,8 +2,144 @@ from hypervisor import FailException
 from hypervisor import logger
 from hypervisor.ssh import SSHConnect
 
+import atexit
+import json
+import os
+import re
+import shlex
+import tempfile
 import time
 import random
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+try:
+    import ovirtsdk4 as sdk
+except ImportError:
+    sdk = None
+
+# plain alphanumeric, the ovirt-shell parser treats < and > as redirections
+_MARKER = "HYPERVISORBUILDERMARKER"
+_CACHE_TTL = 300
+_NMAP_TTL = 30
+# the host and cluster info rarely changes, so it is kept on disk across runs,
+# the vm info is never kept there
+_DISK_CACHE_FILE = os.path.expanduser("~/.cache/hypervisor-builder/rhevm.json")
+_DISK_CACHE_TTL = {"host": 86400, "cluster": 86400}
+_disk_cache = None
+# the fields which change during the life of the object are never cached
+_VOLATILE = {"status-state", "active", "host-id"}
+_OVIRT_SHELL = "ovirt-shell -c"
+_CA_FILE = "/etc/pki/ovirt-engine/ca.pem"
+_CMD_SHOW = "show {otype} {oid}"
+_CMD_LIST_HOSTS = "list hosts"
+_CMD_LIST_VMS = 'list vms --query "name={guest}"'
+_CMD_LIST_NICS = "list nics --parent-vm-name {guest} --show-all"
+_CMD_LIST_DISKS = "list disks --parent-vm-name {guest} --show-all"
+_CMD_DISK_ACTIVATE = "action disk {disk} activate --parent-vm-name {guest}"
+_CMD_VM_ADD = (
+    "add vm --name {guest} --cluster-name {cluster} --template-name {template} "
+    "--placement_policy-host-name {host}"
+)
+_CMD_VM_REMOVE = "remove vm {guest} --vm-disks-detach_only"
+_CMD_VM_START = "action vm {guest} start --vm-placement_policy-host-name {host}"
+_CMD_VM_STOP = "action vm {guest} stop"
+_CMD_VM_SUSPEND = "action vm {guest} suspend"
+_CMD_NIC_MAC = "update nic {nic} --parent-vm-identifier {vm} --mac-address {mac}"
+_OVIRTSHELLRC = (
+    "[ovirt-shell]\n"
+    "username = {user}\n"
+    "password = {pwd}\n"
+    "ca_file = {ca_file}\n"
+    "url = {url}\n"
+    "insecure = False\n"
+    "no_paging = False\n"
+    "filter = False\n"
+    "timeout = -1\n"
+)
+_IP_RE = re.compile(r"(?:\d{1,3}\.){3}\d{1,3}")
+_FIELD_RE = re.compile(r"^([A-Za-z0-9_-]+)\s*:\s*(.*?)\s*$", re.M)
+_UUID_RE = re.compile(r"[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}", re.I)
+
+
+def _parse_field(output, value):
+    """Parse the value of the first field from the ovirt-shell output"""
+    for found in _FIELD_RE.finditer(output):
+        if found.group(1) == value:
+            return found.group(2)
+    return None
+
+
+def _parse_nmap(output):
+    """Parse the ip of each mac from the 'nmap -sP' output"""
+    ips = {}
+    guest_ip = None
+    for line in output.splitlines():
+        if line.startswith("Nmap scan report for"):
+            found = _IP_RE.search(line)
+            guest_ip = found.group() if found else None
+        elif line.startswith("MAC Address:") and guest_ip:
+            ips[line.split()[2].lower()] = guest_ip
+    return ips
+
+
+def _parse_fields(output, value):
+    """Parse the values of all the fields from the ovirt-shell output"""
+    return [f.group(2) for f in _FIELD_RE.finditer(output) if f.group(1) == value]
+
+
+def _load_disk_cache():
+    """Load the disk cache at the first use, it is saved at exit"""
+    global _disk_cache
+    if _disk_cache is None:
+        try:
+            with open(_DISK_CACHE_FILE) as f:
+                _disk_cache = json.load(f)
+        except (OSError, ValueError):
+            _disk_cache = {}
+        atexit.register(_save_disk_cache)
+    return _disk_cache
+
+
+def _save_disk_cache():
+    """Save the unexpired entries of the disk cache"""
+    now = time.time()
+    entries = {k: v for k, v in _disk_cache.items() if v[0] > now}
+    cache_dir = os.path.dirname(_DISK_CACHE_FILE)
+    tmp = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # a unique temp file, the processes exiting together do not clash
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            tmp = f.name
+            json.dump(entries, f)
+        os.replace(tmp, _DISK_CACHE_FILE)
+    except OSError as e:
+        logger.info(f"Failed to save the rhevm cache: {e}")
+        if tmp:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def _sdk_field(obj, value):
+    """Get the ovirt-shell style field, such as 'host-id', from the sdk object"""
+    for attr in value.split("-"):
+        if isinstance(obj, Enum):
+            # ovirt-shell shows the enums as 'status-state'
+            break
+        obj = getattr(obj, attr, None)
+        if obj is None:
+            return None
+    return str(obj.value if isinstance(obj, Enum) else obj)
+
+
+def _sdk_hosts(connection):
+    """Get the names of the VMhosts by the REST API"""
+    return [host.name for host in connection.system_service().hosts_service().list()]
 
 
 class RHEVMCLI:
@@ -20,17 +156,124 @@ class RHEVMCLI:
         self.ssh_user = ssh_user
         self.ssh_pwd = ssh_pwd
         self.ssh = SSHConnect(self.server, user=self.ssh_user, pwd=self.ssh_pwd)
+        self._cache = {}
+        self._guest_cache = {}
+        self._info_cache = {}
+        self._admin_option = admin_option
+        self._sdk = None
+        self._sdk_failed = False
         if not self.shell_connection():
             self.shell_config(*admin_option)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the sdk connection opened by this instance, the ssh connection
+        is shared by all the instances for the server and is kept open
+        """
+        if self._sdk is not None:
+            self._sdk.close()
+            self._sdk = None
+
+    def sdk_connection(self):
+        """
+        Connect the REST API by ovirt-engine-sdk, which is used for the
+        queries instead of ovirt-shell when it is installed and the admin
+        user and password are given
+        :return: the sdk connection, None if it is not available
+        """
+        if (
+            self._sdk is None
+            and not self._sdk_failed
+            and sdk is not None
+            and len(self._admin_option) == 2
+        ):
+            admin_user, admin_pwd = self._admin_option
+            self._sdk = sdk.Connection(
+                url=f"{self.url()}/api",
+                username=admin_user,
+                password=admin_pwd,
+                insecure=True,
+            )
+        return self._sdk
+
+    def _sdk_query(self, fn, *args):
+        """
+        Run the query with the sdk connection, once it fails ovirt-shell is
+        used instead for the life of this instance
+        :param fn: the function to call with the sdk connection and args
+        :return: the result of fn, None if the sdk is not available or failed
+        """
+        connection = self.sdk_connection()
+        if connection is None:
+            return None
+        try:
+            return fn(connection, *args)
+        except sdk.Error as e:
+            logger.info(f"Failed to query rhevm({self.server}) by sdk: {e}")
+            self.close()
+            self._sdk_failed = True
+            return None
+
+    def _ttl_get(self, key, fn, ttl=_CACHE_TTL):
+        """
+        Get the value from the cache, call fn to refresh it once expired,
+        the empty values are not cached
+        :param key: the key for the cached value
+        :param fn: the function to get the value
+        :param ttl: seconds the value is kept
+        :return: the cached value
+        """
+        expiry, value = self._cache.get(key, (0, None))
+        if time.monotonic() >= expiry:
+            value = fn()
+            if value:
+                self._cache[key] = (time.monotonic() + ttl, value)
+        return value
+
+    def _guest_cached(self, guest_name, key):
+        """
+        Get the cached value of the guest, the mac, nic and disk uuid never
+        change during the life of the guest
+        :param guest_name: the name of the guest
+        :param key: the key for the cached value
+        :return: the cached value, None if not cached
+        """
+        return self._guest_cache.get(guest_name, {}).get(key)
+
+    def clear_cache(self):
+        """
+        Drop the cached url, hosts, gateways and info
+        """
+        self._cache.clear()
+        self._info_cache.clear()
+
+    def _drop_vm_info(self, guest_name):
+        """
+        Drop the cached info of the guest, call it once the guest is
+        added or deleted
+        :param guest_name: the name of the guest
+        """
+        self._guest_cache.pop(guest_name, None)
+        for query in [q for q in self._info_cache if q[:2] == ("vm", guest_name)]:
+            del self._info_cache[query]
+
     def url(self):
         """
         Get the URL to the Red Hat Virtualization Manager's REST API.
         This takes the form of https://[server]/ovirt-engine/api.
         :return:
         """
+        return self._ttl_get("url", self._url)
+
+    def _url(self):
         ret, output = self.ssh.runcmd("hostname")
-        if not ret and output is not None and output is not "":
+        if not ret and output.strip():
             hostname = output.strip()
             return f"https://{hostname}:443/ovirt-engine"
         else:
@@ -41,24 +284,21 @@ class RHEVMCLI:
         Generate the mac address randomly.
         :return: mac address
         """
-        mac = [
-            0x06,
-            random.randint(0x00, 0x2F),
-            random.randint(0x00, 0x3F),
-            random.randint(0x00, 0x4F),
-            random.randint(0x00, 0x8F),
-            random.randint(0x00, 0xFF),
+        bits = random.getrandbits(40).to_bytes(5, "big")
+        mac = [0x06] + [
+            byte % (limit + 1)
+            for byte, limit in zip(bits, (0x2F, 0x3F, 0x4F, 0x8F, 0xFF))
         ]
-        return ":".join(map(lambda x: "%02x" % x, mac))
+        return "%02x:%02x:%02x:%02x:%02x:%02x" % tuple(mac)
 
     def shell_connection(self):
         """
         Check if the oVirt manager could be reached.
         :return:
         """
-        cmd = f"echo | ovirt-shell -c -E  'ping'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and "success" in output:
+        cmd = f"{_OVIRT_SHELL} -E 'ping' < /dev/null"
+        ret, _ = self.ssh.runcmd(cmd)
+        if not ret:
             logger.info(f"Succeeded to connect RHEVM({self.server}) shell")
             return True
         else:
@@ -74,21 +314,13 @@ class RHEVMCLI:
         :param admin_pwd: The password for the user attempting access to the RHEVM.
         :return:
         """
-        api_url = f"{self.url()}/api"
-        ca_file = "/etc/pki/ovirt-engine/ca.pem"
-        options = (
-            "insecure = False\n" "no_paging = False\n" "filter = False\n" "timeout = -1"
-        )
-        rhevm_shellrc = "/root/.ovirtshellrc"
-        cmd = (
-            f"echo -e '[ovirt-shell]\n"
-            f"username = {admin_user}\n"
-            f"password = {admin_pwd}\n"
-            f"ca_file = {ca_file}\n"
-            f"url = {api_url}\n"
-            f"{options}' > {rhevm_shellrc}"
+        content = _OVIRTSHELLRC.format(
+            user=admin_user,
+            pwd=admin_pwd,
+            ca_file=_CA_FILE,
+            url=f"{self.url()}/api",
         )
-        self.ssh.runcmd(cmd)
+        self.ssh.write_file(content, "/root/.ovirtshellrc")
         self.ssh.runcmd("ovirt-aaa-jdbc-tool user unlock admin")
 
     def info(self):
@@ -96,12 +328,45 @@ class RHEVMCLI:
         Get the VMhost info
         :return: the VMHosts info
         """
-        cmd = "ovirt-shell -c -E 'list hosts' | grep '^name' | awk -F ':' '{print $2}'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and output is not None and output is not "":
-            hosts = output.strip().split("\n")
-        else:
-            hosts = list()
+        return self._ttl_get("info", self._info)
+
+    @classmethod
+    def info_many(cls, servers):
+        """
+        Get the VMhost info of several RHEVM servers in parallel, the workers
+        are kept below the default MaxStartups of sshd, each server is only
+        queried once and its pooled ssh connection is kept open
+        :param servers: list of (server, ssh_user, ssh_pwd, *admin_option) tuples
+        :return: dict of the VMHosts info for each server
+        """
+        servers = list({args[0]: args for args in servers}.values())
+        if not servers:
+            return {}
+
+        def server_info(args):
+            rhevm = cls(*args)
+            try:
+                return rhevm.info()
+            finally:
+                # only the sdk connection of this instance is closed
+                rhevm.close()
+
+        with ThreadPoolExecutor(max_workers=min(8, len(servers))) as executor:
+            hosts = executor.map(server_info, servers)
+            return {args[0]: info for args, info in zip(servers, hosts)}
+
+    def primary_host(self):
+        """
+        Get the first VMhost, which is the default host for new guests
+        :return: the name of the VMhost
+        """
+        return self.info()[0]
+
+    def _info(self):
+        hosts = self._sdk_query(_sdk_hosts)
+        if hosts is None:
+            ret, (output,) = self._ovirt_exec(_CMD_LIST_HOSTS)
+            hosts = _parse_fields(output, "name") if not ret else list()
         logger.info(f"Get RHEVM Host: {hosts}")
         return hosts
 
@@ -114,26 +379,161 @@ class RHEVMCLI:
         :param host_pwd: the ssh password for the RHEVM host
         :return: guest attributes, exclude guest_name, guest_ip, guest_uuid ...
         """
-        host_id = self.get_rhevm_info("vm", guest_name, "host-id")
-        cluster_id = self.get_rhevm_info("vm", guest_name, "cluster-id")
+        # the guest ip is looked up on the RHEVM host, so it runs in
+        # parallel with the info queries on the RHEVM server
+        executor = ThreadPoolExecutor(max_workers=1)
+        guest_ip = executor.submit(
+            self.get_guest_ip, guest_name, host_ip, host_user, host_pwd
+        )
+        executor.shutdown(wait=False)
+        vm = self.get_rhevm_info_batch(
+            [
+                ("vm", guest_name, "host-id"),
+                ("vm", guest_name, "cluster-id"),
+                ("vm", guest_name, "id"),
+                ("vm", guest_name, "status-state"),
+            ]
+        )
+        host_id = vm[("vm", guest_name, "host-id")]
+        cluster_id = vm[("vm", guest_name, "cluster-id")]
+        host = self.get_rhevm_info_batch(
+            [
+                ("host", host_id, "hardware_information-uuid"),
+                ("host", host_id, "name"),
+                ("host", host_id, "version-full_version"),
+                ("host", host_id, "cpu-topology-sockets"),
+                ("cluster", cluster_id, "name"),
+            ]
+        )
         guest_msgs = {
             "guest_name": guest_name,
-            "guest_ip": self.get_guest_ip(guest_name, host_ip, host_user, host_pwd),
-            "guest_uuid": self.get_rhevm_info("vm", guest_name, "id"),
-            "guest_state": self.get_rhevm_info("vm", guest_name, "status-state"),
+            "guest_ip": guest_ip.result(),
+            "guest_uuid": vm[("vm", guest_name, "id")],
+            "guest_state": vm[("vm", guest_name, "status-state")],
             "vdsm_uuid": host_id,
-            "vdsm_hwuuid": self.get_rhevm_info(
-                "host", host_id, "hardware_information-uuid"
-            ),
-            "vdsm_hostname": self.get_rhevm_info("host", host_id, "name"),
-            "vdsm_version": self.get_rhevm_info(
-                "host", host_id, "version-full_version"
-            ),
-            "vdsm_cpu": self.get_rhevm_info("host", host_id, "cpu-topology-sockets"),
-            "vdsm_cluster": self.get_rhevm_info("cluster", cluster_id, "name"),
+            "vdsm_hwuuid": host[("host", host_id, "hardware_information-uuid")],
+            "vdsm_hostname": host[("host", host_id, "name")],
+            "vdsm_version": host[("host", host_id, "version-full_version")],
+            "vdsm_cpu": host[("host", host_id, "cpu-topology-sockets")],
+            "vdsm_cluster": host[("cluster", cluster_id, "name")],
         }
         return guest_msgs
 
+    def _ovirt_exec(self, *commands):
+        """
+        Run the ovirt-shell commands in one ovirt-shell process, so the shell
+        startup and the login to the engine are paid once for all of them
+        :param commands: the ovirt-shell commands, such as 'show vm X'
+        :return: the return code and the list of output for each command
+        :raise FailException: if the output does not split into one section
+        for each command
+        """
+        if len(commands) == 1:
+            cmd = f"{_OVIRT_SHELL} -E {shlex.quote(commands[0])}"
+            ret, output = self.ssh.runcmd(cmd)
+            return ret, [output]
+        script = "\n".join(f"echo {_MARKER}\n{command}" for command in commands)
+        cmd = f"{_OVIRT_SHELL} <<'EOF'\n{script}\nexit\nEOF"
+        ret, output = self.ssh.runcmd(cmd, if_stdout=True)
+        outputs = output.split(_MARKER)[1:]
+        if len(outputs) != len(commands):
+            raise FailException(
+                f"Failed to split the ovirt-shell output of rhevm({self.server}), "
+                f"got {len(outputs)} sections for {len(commands)} commands"
+            )
+        return ret, outputs
+
+    def get_rhevm_info_batch(self, queries):
+        """
+        Get several info from RHEVM in one ovirt-shell process, each object
+        is shown only once however many values are queried from it
+        :param queries: list of (object_type, object_id, value) tuples
+        :return: dict of the value for each query, None if not found
+        """
+        cache = _load_disk_cache()
+        now = time.time()
+        results = {}
+        missed = []
+        for query in queries:
+            key = "|".join(map(str, (self.server,) + tuple(query)))
+            if query[1] is None:
+                # such as the host of a guest which is down
+                results[query] = None
+            elif query in self._info_cache:
+                results[query] = self._info_cache[query]
+            elif key in cache and cache[key][0] > now:
+                results[query] = cache[key][1]
+            else:
+                missed.append(query)
+        if missed:
+            batch = self._sdk_query(self._sdk_info_batch, missed)
+            if batch is None:
+                batch = self._shell_info_batch(missed)
+            results.update(batch)
+        for query in missed:
+            if query[2] not in _VOLATILE and results[query] is not None:
+                self._info_cache[query] = results[query]
+            ttl = _DISK_CACHE_TTL.get(query[0])
+            if ttl and query[1] and results[query] is not None:
+                key = "|".join(map(str, (self.server,) + tuple(query)))
+                cache[key] = (now + ttl, results[query])
+        return results
+
+    def _shell_info_batch(self, queries):
+        """
+        Get several info from RHEVM by ovirt-shell
+        :param queries: list of (object_type, object_id, value) tuples
+        :return: dict of the value for each query, None if not found
+        """
+        objects = list(dict.fromkeys((t, i) for t, i, _ in queries))
+        ret, outputs = self._ovirt_exec(
+            *(_CMD_SHOW.format(otype=t, oid=i) for t, i in objects)
+        )
+        sections = dict(zip(objects, outputs))
+        results = {}
+        for query in queries:
+            object_type, object_id, value = query
+            result = _parse_field(sections.get((object_type, object_id), ""), value)
+            msg = f"rhevm {object_type} ({object_id}) {value}"
+            if not ret and result is not None:
+                logger.info(f"Succeeded to get {msg}: {result}")
+            else:
+                logger.info(f"Failed to get {msg}")
+                result = None
+            results[query] = result
+        return results
+
+    def _sdk_info_batch(self, connection, queries):
+        """
+        Get several info from RHEVM by the REST API
+        :param connection: the sdk connection
+        :param queries: list of (object_type, object_id, value) tuples
+        :return: dict of the value for each query, None if not found
+        """
+        system = connection.system_service()
+        services = {
+            "vm": system.vms_service(),
+            "host": system.hosts_service(),
+            "cluster": system.clusters_service(),
+        }
+        objects = {}
+        results = {}
+        for query in queries:
+            object_type, object_id, value = query
+            if (object_type, object_id) not in objects:
+                field = "id" if _UUID_RE.fullmatch(str(object_id)) else "name"
+                found = services[object_type].list(search=f"{field}={object_id}")
+                objects[(object_type, object_id)] = found[0] if found else None
+            obj = objects[(object_type, object_id)]
+            result = _sdk_field(obj, value) if obj else None
+            msg = f"rhevm {object_type} ({object_id}) {value}"
+            if result is not None:
+                logger.info(f"Succeeded to get {msg}: {result}")
+            else:
+                logger.info(f"Failed to get {msg}")
+            results[query] = result
+        return results
+
     def get_rhevm_info(self, object_type, object_id, value):
         """
         Get the info from RHEVM
@@ -142,17 +542,8 @@ class RHEVMCLI:
         :param value: the value you want to get from the result
         :return: the value you want to get
         """
-        cmd = f"ovirt-shell -c -E 'show {object_type} {object_id}' |grep '^{value}'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and value in output:
-            result = output.strip().split(":")[1].strip()
-            logger.info(
-                f"Succeeded to get rhevm {object_type} ({object_id}) {value}: {result}"
-            )
-            return result
-        else:
-            logger.info(f"Failed to get rhevm {object_type} ({object_id}) {value}")
-            return None
+        query = (object_type, object_id, value)
+        return self.get_rhevm_info_batch([query])[query]
 
     def get_guest_ip(self, guest_name, host_ip, host_user, host_pwd):
         """
@@ -163,18 +554,53 @@ class RHEVMCLI:
         :param host_pwd: the ssh password for the RHEVM host
         :return:
         """
-        gateway = self.get_gateway(host_ip, host_user, host_pwd)
         guest_mac = self.get_guest_mac(guest_name)
-        option = "grep 'Nmap scan report for' | grep -Eo '([0-9]{1,3}[\.]){3}[0-9]{1,3}'| tail -1"
-        cmd = f"nmap -sP -n {gateway} | grep -i -B 2 {guest_mac} | {option}"
-        ret, output = SSHConnect(host_ip, host_user, host_pwd).runcmd(cmd)
-        if not ret and output is not None and output is not "":
-            guest_ip = output.strip()
+        if not guest_mac:
+            logger.info("Failed to get rhevm guest ip without the mac")
+            return None
+        # the connection is reused from the SSHConnect pool
+        ssh_host = SSHConnect(host_ip, host_user, host_pwd)
+        # the neighbor table of the host usually knows the guest already,
+        # only ping-sweep the host network by nmap if it does not
+        cmd = (
+            f"ip -4 neigh show | awk -v m={guest_mac.lower()} "
+            f"'tolower($5)==m {{print $1; exit}}'"
+        )
+        ret, output = ssh_host.runcmd(cmd)
+        guest_ip = output.strip() if not ret else None
+        if not guest_ip:
+            gateway = self.get_gateway(host_ip, host_user, host_pwd)
+            key = ("nmap", gateway)
+            scanned = []
+
+            def scan():
+                scanned.append(gateway)
+                return self._nmap_scan(ssh_host, gateway)
+
+            ips = self._ttl_get(key, scan, ttl=_NMAP_TTL)
+            guest_ip = ips.get(guest_mac.lower())
+            if not guest_ip and not scanned:
+                # the guest may come up after the cached scan, scan once more
+                self._cache.pop(key, None)
+                ips = self._ttl_get(key, scan, ttl=_NMAP_TTL)
+                guest_ip = ips.get(guest_mac.lower())
+        if guest_ip:
             logger.info(f"Succeeded to get rhevm guest ip ({guest_ip})")
-            return output.strip()
+            return guest_ip
         else:
             logger.info(f"Failed to get rhevm guest ip")
 
+    def _nmap_scan(self, ssh_host, gateway):
+        """
+        Ping-sweep the host network by nmap, the result is cached for a
+        while so that looking up several guests scans only once
+        :param ssh_host: the SSHConnect for the RHEVM host
+        :param gateway: the network to scan
+        :return: dict of the ip for each mac
+        """
+        ret, output = ssh_host.runcmd(f"nmap -sP -n {gateway}", if_stdout=True)
+        return _parse_nmap(output) if not ret else {}
+
     def get_gateway(self, host_ip, host_user, host_pwd):
         """
         Get the gateway by ip route command
@@ -183,9 +609,15 @@ class RHEVMCLI:
         :param host_pwd: the ssh password for the RHEVM host
         :return: the gateway for host
         """
+        return self._ttl_get(
+            ("gateway", host_ip),
+            lambda: self._gateway(host_ip, host_user, host_pwd),
+        )
+
+    def _gateway(self, host_ip, host_user, host_pwd):
         cmd = f"ip route | grep {host_ip}"
         ret, output = SSHConnect(host_ip, host_user, host_pwd).runcmd(cmd)
-        if not ret and output is not None and output is not "":
+        if not ret and output.strip():
             output = output.strip().split(" ")
             if len(output) > 0:
                 gateway = output[0]
@@ -198,28 +630,48 @@ class RHEVMCLI:
         :param guest_name: name for the specific guest
         :return: the mac address for the guest
         """
-        cmd = f"ovirt-shell -c -E 'list nics --parent-vm-name {guest_name} --show-all' | grep  '^mac-address'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and "mac-address" in output:
-            mac_addr = output.strip().split(": ")[1].strip()
+        if self._guest_cached(guest_name, "mac"):
+            return self._guest_cached(guest_name, "mac")
+        ret, (output,) = self._ovirt_exec(_CMD_LIST_NICS.format(guest=guest_name))
+        mac_addr = _parse_field(output, "mac-address")
+        if not ret and mac_addr:
             logger.info(f"rhevm({self.server}) guest mac is: {mac_addr}")
+            self._guest_cache.setdefault(guest_name, {})["mac"] = mac_addr
             return mac_addr
         else:
             logger.info(f"Failed to check rhevm({self.server}) guest mac")
             return None
 
-    def guest_disk_uuid(self, guest_name):
+    def _list_disks(self, guest_name):
+        """
+        Get the disk record of the guest in one query, which feeds the disk
+        uuid, status and active checks
+        :param guest_name: the name of the guest
+        :return: dict of the disk fields, empty if the query failed
+        """
+        ret, (output,) = self._ovirt_exec(_CMD_LIST_DISKS.format(guest=guest_name))
+        if ret:
+            return {}
+        return {
+            "id": _parse_field(output, "id"),
+            "names": _parse_fields(output, "name"),
+            "active": _parse_field(output, "active"),
+            "status_state": _parse_field(output, "status-state"),
+        }
+
+    def guest_disk_uuid(self, guest_name, disks=None):
         """
         Get the uuid of the disk
         :param guest_name: the name of the guest
+        :param disks: the disk record already got by _list_disks
         :return: the uuid of the disk
         """
-        vm_options = "--parent-vm-name {0}".format(guest_name)
-        cmd = f"ovirt-shell -c -E 'list disks {vm_options}' | grep '^id'"
-        ret, output = self.ssh.runcmd(cmd)
-        if ret == 0 and "id" in output:
-            uuid = output.strip().split(":")[1].strip()
+        if self._guest_cached(guest_name, "disk_uuid"):
+            return self._guest_cached(guest_name, "disk_uuid")
+        uuid = (disks or self._list_disks(guest_name)).get("id")
+        if uuid:
             logger.info(f"rhevm({self.server}) disk uuid for guest: {uuid}")
+            self._guest_cache.setdefault(guest_name, {})["disk_uuid"] = uuid
             return uuid
         else:
             raise FailException(
@@ -233,33 +685,30 @@ class RHEVMCLI:
         :param disk: the name of the disk
         :return:
         """
-        vm_options = "--parent-vm-name {0}".format(guest_name)
-        cmd = f"ovirt-shell -c -E 'list disks {vm_options}' | grep '^name'"
-        ret, output = self.ssh.runcmd(cmd)
-        if ret != 0 or disk not in output:
+        disks = self._list_disks(guest_name)
+        if not any(disk in name for name in disks.get("names", [])):
             raise FailException(f"rhevm({self.server}) guest disk is not exist")
-        disk_uuid = self.guest_disk_uuid(guest_name)
-        is_actived_disk = ""
-        status = ""
-        for i in range(60):
-            time.sleep(60)
-            if self.guest_disk_is_actived(guest_name):
-                is_actived_disk = "Yes"
-            else:
-                cmd = (
-                    f"ovirt-shell -c -E 'action disk {disk_uuid} activate {vm_options}'"
-                )
-                self.ssh.runcmd(cmd)
-            if is_actived_disk == "Yes" and self.guest_disk_status(guest_name) == "ok":
-                logger.info(
-                    f"rhevm({self.server}) guest disk is actived and status is ok"
-                )
-                status = "ok"
-                break
-        if is_actived_disk != "Yes" or status != "ok":
-            raise FailException(
-                f"Failed to create rhevm({self.server}) guest as disk can't be actived"
+        disk_uuid = self.guest_disk_uuid(guest_name, disks)
+
+        def disk_ok():
+            disks = self._list_disks(guest_name)
+            logger.info(
+                f"rhevm({self.server}) disk for guest active: {disks.get('active')}, "
+                f"status: {disks.get('status_state')}"
             )
+            if disks.get("active") != "True":
+                self._ovirt_exec(
+                    _CMD_DISK_ACTIVATE.format(disk=disk_uuid, guest=guest_name)
+                )
+                return False
+            return disks.get("status_state") == "ok"
+
+        if self._wait_state(disk_ok, timeout=3600):
+            logger.info(f"rhevm({self.server}) guest disk is actived and status is ok")
+            return
+        raise FailException(
+            f"Failed to create rhevm({self.server}) guest as disk can't be actived"
+        )
 
     def guest_disk_status(self, guest_name):
         """
@@ -267,11 +716,8 @@ class RHEVMCLI:
         :param guest_name:
         :return: the status for the disk
         """
-        vm_options = f"--parent-vm-name {guest_name}"
-        cmd = f"ovirt-shell -c -E 'list disks {vm_options} --show-all' | grep '^status-state'"
-        ret, output = self.ssh.runcmd(cmd)
-        if ret == 0 and "status-state" in output:
-            status = output.strip().split(":")[1].strip()
+        status = self._list_disks(guest_name).get("status_state")
+        if status:
             logger.info(f"rhevm({self.server}) disk for guest status: {status}")
             return status
         else:
@@ -285,13 +731,7 @@ class RHEVMCLI:
         :param guest_name: the name of the guest
         :return:
         """
-        vm_options = f"--parent-vm-name {guest_name}"
-        cmd = f"ovirt-shell -c -E 'list disks {vm_options} --show-all' | grep '^active'"
-        ret, output = self.ssh.runcmd(cmd)
-        if ret == 0 and "True" in output:
-            return True
-        else:
-            return False
+        return self._list_disks(guest_name).get("active") == "True"
 
     def guest_nic(self, guest_name):
         """
@@ -299,12 +739,13 @@ class RHEVMCLI:
         :param guest_name:
         :return:
         """
-        options = f"list nics --parent-vm-name {guest_name} --show-all"
-        cmd = f"ovirt-shell -c -E '{options}' | grep  '^name'"
-        ret, output = self.ssh.runcmd(cmd)
-        if ret == 0 and "name" in output:
-            nic = output.strip().split(": ")[1].strip()
+        if self._guest_cached(guest_name, "nic"):
+            return self._guest_cached(guest_name, "nic")
+        ret, (output,) = self._ovirt_exec(_CMD_LIST_NICS.format(guest=guest_name))
+        nic = _parse_field(output, "name")
+        if ret == 0 and nic:
             logger.info(f"rhevm({self.server}) guest nic is: {nic}")
+            self._guest_cache.setdefault(guest_name, {})["nic"] = nic
             return nic
         else:
             raise FailException(f"Failed to check rhevm({self.server}) guest nic")
@@ -322,25 +763,25 @@ class RHEVMCLI:
         :param host_name: the name of the rhevm host
         :return:
         """
+        self._drop_vm_info(guest_name)
         if not host_name:
-            host_name = self.info()[0]
+            host_name = self.primary_host()
         if self.guest_exist(guest_name):
             self.guest_del(guest_name)
-        cmd = (
-            f"ovirt-shell -c -E 'add vm "
-            f"--name {guest_name} "
-            f"--cluster-name {cluster} "
-            f"--template-name {template} "
-            f"--placement_policy-host-name {host_name}'"
+        _, (_, vm) = self._ovirt_exec(
+            _CMD_VM_ADD.format(
+                guest=guest_name, cluster=cluster, template=template, host=host_name
+            ),
+            _CMD_SHOW.format(otype="vm", oid=guest_name),
         )
-        self.ssh.runcmd(cmd)
-        guest_uuid = self.get_rhevm_info("vm", guest_name, "id")
+        guest_uuid = _parse_field(vm, "id")
         guest_nic = self.guest_nic(guest_name)
         guest_mac = self.random_mac()
-        vm_options = f"--parent-vm-identifier {guest_uuid}"
-        cmd = f"ovirt-shell -c -E 'update nic {guest_nic} {vm_options} --mac-address {guest_mac}'"
-        self.ssh.runcmd(cmd)
+        self._ovirt_exec(
+            _CMD_NIC_MAC.format(nic=guest_nic, vm=guest_uuid, mac=guest_mac)
+        )
         logger.info(f"rhevm({self.server}) guest new mac is: {guest_mac}")
+        self._guest_cache.setdefault(guest_name, {})["mac"] = guest_mac
         self.guest_disk_ready(guest_name, disk)
         self.guest_start(guest_name)
 
@@ -350,11 +791,14 @@ class RHEVMCLI:
         :param guest_name: the virtual machines you want to remove.
         :return: remove successfully, return True, else, return False.
         """
+        self._drop_vm_info(guest_name)
         if self.guest_exist(guest_name):
             self.guest_stop(guest_name)
-            cmd = f"ovirt-shell -c -E 'remove vm {guest_name} --vm-disks-detach_only'"
-            ret, _ = self.ssh.runcmd(cmd)
-            if not ret and self.guest_exist(guest_name) is False:
+            ret, (_, vms) = self._ovirt_exec(
+                _CMD_VM_REMOVE.format(guest=guest_name),
+                _CMD_LIST_VMS.format(guest=guest_name),
+            )
+            if not ret and guest_name not in _parse_fields(vms, "name"):
                 logger.info(f"Succeeded to delete rhevm({self.server}) guest")
                 return True
             else:
@@ -367,15 +811,50 @@ class RHEVMCLI:
         :param guest_name: the name for the guest
         :return: guest exists, return True, else, return False.
         """
-        cmd = f"ovirt-shell -c -E 'show vm {guest_name}' |grep '^name'"
-        ret, output = self.ssh.runcmd(cmd)
-        if not ret and guest_name in output:
+        ret, (output,) = self._ovirt_exec(_CMD_LIST_VMS.format(guest=guest_name))
+        if not ret and guest_name in _parse_fields(output, "name"):
             logger.info(f"rhevm({self.server}) guest {guest_name} is exist")
             return True
         else:
             logger.info(f"rhevm({self.server}) guest {guest_name} is not exist")
             return False
 
+    def _wait_state(self, check_fn, timeout=600, initial=1.0, cap=30.0):
+        """
+        Poll until check_fn returns True, the interval grows from initial
+        to cap seconds
+        :param check_fn: the function to check the state
+        :param timeout: max seconds to poll
+        :param initial: the first interval
+        :param cap: the max interval
+        :return: True if the state is reached before the timeout
+        """
+        delay = initial
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if check_fn():
+                return True
+            time.sleep(delay)
+            delay = min(delay * 1.5, cap)
+        return False
+
+    def _wait_vm_status(self, guest_name, status, current, timeout=300):
+        """
+        Wait for the guest to reach the status after a power action
+        :param guest_name: the name of the guest
+        :param status: the expected status, such as up, down or suspended
+        :param current: the status got right after the action
+        :param timeout: max seconds to wait
+        :return: True if the guest reaches the status
+        """
+        if current == status:
+            return True
+        return self._wait_state(
+            lambda: self.get_rhevm_info("vm", guest_name, "status-state") == status,
+            timeout=timeout,
+            cap=15.0,
+        )
+
     def guest_start(self, guest_name, host_name=None):
         """
         Power on virtual machines.
@@ -388,13 +867,16 @@ class RHEVMCLI:
             logger.info(f"Rhevm({self.server}) guest is in Up status")
             return True
         if not host_name:
-            host_name = self.info()[0]
-        cmd = f"ovirt-shell -c -E 'action vm {guest_name} start --vm-placement_policy-host-name {host_name}'"
-        ret, output = self.ssh.runcmd(cmd)
+            host_name = self.primary_host()
+        ret, (output, vm) = self._ovirt_exec(
+            _CMD_VM_START.format(guest=guest_name, host=host_name),
+            _CMD_SHOW.format(otype="vm", oid=guest_name),
+        )
+        # the guest may still be powering up when the action returns
         if (
             not ret
             and "ERROR" not in output
-            and self.get_rhevm_info("vm", guest_name, "status-state") == "up"
+            and self._wait_vm_status(guest_name, "up", _parse_field(vm, "status-state"))
         ):
             logger.info(f"Succeeded to start rhevm({self.server}) guest")
             return True
@@ -408,10 +890,12 @@ class RHEVMCLI:
         :param guest_name: the virtual machines you want to power off.
         :return: stop successfully, return True, else, return False.
         """
-        cmd = f"ovirt-shell -c -E 'action vm {guest_name} stop'"
-        ret, _ = self.ssh.runcmd(cmd)
-        status = self.get_rhevm_info("vm", guest_name, "status-state")
-        if not ret and status == "down":
+        ret, (_, vm) = self._ovirt_exec(
+            _CMD_VM_STOP.format(guest=guest_name),
+            _CMD_SHOW.format(otype="vm", oid=guest_name),
+        )
+        status = _parse_field(vm, "status-state")
+        if not ret and self._wait_vm_status(guest_name, "down", status):
             logger.info(f"Succeeded to stop rhevm({self.server}) guest")
             return True
         else:
@@ -426,12 +910,12 @@ class RHEVMCLI:
         if self.get_rhevm_info("vm", guest_name, "status-state") == "suspended":
             logger.info(f"Rhevm({self.server}) guest is in suspended status")
             return True
-        cmd = f"ovirt-shell -c -E 'action vm {guest_name} suspend'"
-        ret, _ = self.ssh.runcmd(cmd)
-        if (
-            not ret
-            and self.get_rhevm_info("vm", guest_name, "status-state") == "suspended"
-        ):
+        ret, (_, vm) = self._ovirt_exec(
+            _CMD_VM_SUSPEND.format(guest=guest_name),
+            _CMD_SHOW.format(otype="vm", oid=guest_name),
+        )
+        status = _parse_field(vm, "status-state")
+        if not ret and self._wait_vm_status(guest_name, "suspended", status):
             logger.info(f"Succeeded to suspend rhevm({self.server}) guest")
             return True
         else:
@@ -0,0 +1,218 @@
+import io
+import json
+import time
+
+import pytest
+
+pytest.importorskip("urllib3")
+
+from hypervisor.virt.kubevirt import kubevirtapi  # noqa: E402
+from hypervisor.virt.kubevirt.kubevirtapi import KubevirtApi  # noqa: E402
+
+
+def page(name, token=None):
+    metadata = {"continue": token} if token else {}
+    return {"metadata": metadata, "items": [{"metadata": {"name": name}}]}
+
+
+PAGES = {None: page("a", "page2"), "page2": page("b", "page3"), "page3": page("c")}
+
+
+class StreamResponse(io.BytesIO):
+    released = False
+
+    def release_conn(self):
+        self.released = True
+
+
+def page_request(raw=False):
+    """Fake KubevirtApi._request serving PAGES by the continue token"""
+    calls = []
+
+    def request(path, method="GET", field=None, raw=raw, stream=False):
+        fields = dict(field or {})
+        calls.append(fields)
+        data = PAGES[fields.get("continue")]
+        if stream:
+            return StreamResponse(json.dumps(data).encode())
+        return json.dumps(data).encode() if raw else data
+
+    return request, calls
+
+
+@pytest.fixture
+def api():
+    return KubevirtApi("https://kubevirt.example.com", "token")
+
+
+def test_lazy_names_multiple_pages(api):
+    pytest.importorskip("simdjson")
+    api._request, calls = page_request(raw=True)
+    assert api._lazy_names("/api/v1/nodes") == ["a", "b", "c"]
+    assert [c.get("continue") for c in calls] == [None, "page2", "page3"]
+
+
+def test_stream_names_multiple_pages(api):
+    pytest.importorskip("ijson")
+    api._request, calls = page_request()
+    assert api._stream_names("/api/v1/nodes") == ["a", "b", "c"]
+    assert [c.get("continue") for c in calls] == [None, "page2", "page3"]
+
+
+def test_get_nodes_list_ijson(api, monkeypatch):
+    pytest.importorskip("ijson")
+    monkeypatch.setattr(kubevirtapi, "simdjson", None)
+    api._request, _ = page_request()
+    assert api.get_nodes_list() == ["a", "b", "c"]
+
+
+def test_get_nodes_list_fallback(api, monkeypatch):
+    monkeypatch.setattr(kubevirtapi, "simdjson", None)
+    monkeypatch.setattr(kubevirtapi, "ijson", None)
+    api._request, _ = page_request()
+    assert api.get_nodes_list() == ["a", "b", "c"]
+
+
+def test_request_list_multiple_pages(api):
+    api._request, calls = page_request()
+    data = api._request_list("/api/v1/nodes")
+    assert [i["metadata"]["name"] for i in data["items"]] == ["a", "b", "c"]
+    assert len(calls) == 3
+    # the merged list is cached
+    assert api._request_list("/api/v1/nodes") is data
+    assert len(calls) == 3
+
+
+def test_request_many(api):
+    api._request, calls = page_request()
+    nodes, selected = api._request_many(
+        ["/api/v1/nodes", "/api/v1/nodes"], [None, "metadata.name=a"]
+    )
+    assert [i["metadata"]["name"] for i in nodes["items"]] == ["a", "b", "c"]
+    assert set(api._list_cache) == {
+        ("/api/v1/nodes", None),
+        ("/api/v1/nodes", "metadata.name=a"),
+    }
+    assert len(calls) == 6
+    assert api._request_many([]) == []
+
+
+def test_get_nodes_list_simdjson(api, monkeypatch):
+    pytest.importorskip("simdjson")
+    monkeypatch.setattr(kubevirtapi, "ijson", None)
+    api._request, _ = page_request(raw=True)
+    assert api.get_nodes_list() == ["a", "b", "c"]
+
+
+def test_guests_search_many_shares_cache(api):
+    vmis = {
+        "items": [
+            {
+                "metadata": {"name": f"vm{i}"},
+                "spec": {"domain": {"firmware": {"uuid": f"uuid{i}"}}},
+                "status": {"nodeName": "node", "phase": "Running"},
+            }
+            for i in range(300)
+        ],
+        "metadata": {},
+    }
+    nodes = {
+        "items": [
+            {
+                "metadata": {"name": "node"},
+                "status": {
+                    "nodeInfo": {"machineID": "id", "kubeletVersion": "v1"},
+                    "allocatable": {"cpu": "4"},
+                    "addresses": [{"type": "Hostname", "address": "node"}],
+                },
+            }
+        ],
+        "metadata": {},
+    }
+
+    calls = []
+
+    def request(path, method="GET", field=None, raw=False, stream=False):
+        calls.append(path)
+        if path == "/apis/kubevirt.io":
+            return {"preferredVersion": {"version": "v1"}}
+        if path == "/api/v1/nodes":
+            # a slow list, the concurrent searches would all miss the cache
+            time.sleep(0.05)
+            return nodes
+        name = field["fieldSelector"].split("=")[1]
+        items = [i for i in vmis["items"] if i["metadata"]["name"] == name]
+        return dict(vmis, items=items)
+
+    api._request = request
+    names = [f"vm{i}" for i in range(300)]
+    results = api.guests_search_many(names, 22, workers=16)
+    assert [r["guest_uuid"] for r in results] == [f"uuid{i}" for i in range(300)]
+    assert all(r["guest_ip"] == "node:22" for r in results)
+    # the shared node list and api version are fetched once
+    assert calls.count("/api/v1/nodes") == 1
+    assert calls.count("/apis/kubevirt.io") == 1
+
+
+def test_request_list_evicts_expired(api, monkeypatch):
+    api._request, _ = page_request()
+    now = [1000.0]
+    monkeypatch.setattr(kubevirtapi.time, "monotonic", lambda: now[0])
+    for i in range(10):
+        api._request_list("/api/v1/nodes", f"metadata.name=n{i}")
+    assert len(api._list_cache) == 10
+    now[0] += kubevirtapi._CACHE_TTL
+    api._request_list("/api/v1/nodes")
+    assert list(api._list_cache) == [("/api/v1/nodes", None)]
+
+
+class FakeResponse:
+    def __init__(self, status, data=b"", etag=None):
+        self.status = status
+        self.data = data
+        self.headers = {"ETag": etag} if etag else {}
+
+
+class FakePoolManager:
+    """Reply 304 when the etag of the url matches, else the page"""
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, fields=None, headers=None, **kwargs):
+        self.requests.append((url, dict(fields or {}), dict(headers)))
+        etag = f'"{url}"'
+        if headers.get("If-None-Match") == etag:
+            return FakeResponse(304)
+        page = PAGES[(fields or {}).get("continue")]
+        return FakeResponse(200, json.dumps(page).encode(), etag)
+
+
+def test_request_etag(api):
+    api._pool_manager = FakePoolManager()
+    first = api._request("/api/v1/nodes", field={"limit": 1})
+    assert api._request("/api/v1/nodes", field={"limit": 1}) is first
+    url = "https://kubevirt.example.com/api/v1/nodes"
+    assert api._pool_manager.requests[1][2]["If-None-Match"] == f'"{url}"'
+
+
+def test_request_etag_skips_continue(api):
+    api._pool_manager = FakePoolManager()
+    api._request("/api/v1/nodes", field={"limit": 1, "continue": "page2"})
+    assert len(api._etags) == 0
+
+
+def test_request_etag_lru(api, monkeypatch):
+    monkeypatch.setattr(kubevirtapi, "_ETAG_CACHE_SIZE", 2)
+    api._pool_manager = FakePoolManager()
+    for path in ("/a", "/b", "/a", "/c"):
+        api._request(path)
+    assert [key[0] for key in api._etags] == [
+        "https://kubevirt.example.com/a",
+        "https://kubevirt.example.com/c",
+    ]
+
+
+def test_retry_only_get(api):
+    retries = api._pool_manager.connection_pool_kw["retries"]
+    assert retries.allowed_methods == {"GET"}
@@ -0,0 +1,84 @@
+import subprocess
+
+import pytest
+
+pytest.importorskip("paramiko")
+
+from hypervisor.virt.libvirt.libvirtcli import LibvirtCLI  # noqa: E402
+
+XML = """<domain>
+  <name>template</name>
+  <source file='/var/lib/libvirt/images/template.qcow2'/>
+  <mac address='52:54:00:00:00:00'/>
+</domain>
+"""
+
+
+class FakeSSH:
+    """SSHConnect running the sed commands locally, the others only recorded"""
+
+    def __init__(self):
+        self.cmds = []
+
+    def runcmd(self, cmd, if_stdout=False):
+        self.cmds.append(cmd)
+        if cmd.startswith("sed "):
+            ret = subprocess.run(["bash", "-c", cmd]).returncode
+            return ret, ""
+        if cmd.startswith("curl "):
+            return 0, "0 0\n"
+        return 1, ""
+
+    def close(self):
+        pass
+
+
+def test_guest_image_download_quoting(tmp_path, monkeypatch):
+    guest_name = "it's a|b&c"
+    xml_file = tmp_path / f"{guest_name}.xml"
+    xml_file.write_text(XML)
+    libvirt = LibvirtCLI("libvirt.example.com", "root", "pwd")
+    libvirt.ssh = FakeSSH()
+    monkeypatch.setattr(libvirt, "url_validation", lambda url: True)
+    monkeypatch.setattr(libvirt, "rhel_version", lambda: "8")
+    monkeypatch.setattr(libvirt, "randomMAC", lambda: "52:54:00:12:34:56")
+    image_path = str(tmp_path / "images dir")
+    libvirt.guest_image_download(
+        guest_name, "http://a/b.qcow2", "http://a/b.xml", image_path, str(tmp_path)
+    )
+    xml = xml_file.read_text()
+    assert f"<name>{guest_name}</name>" in xml
+    assert f'<source file="{image_path}/{guest_name}.qcow2"/>' in xml
+    assert '<mac address="52:54:00:12:34:56"/>' in xml
+    assert libvirt.ssh.cmds[-1] == f"virsh define '{tmp_path}/it'\"'\"'s a|b&c.xml'"
+    assert f"rm -rf '{image_path}'" in libvirt.ssh.cmds[1]
+
+
+class StartSSH:
+    """SSHConnect failing the first guest start"""
+
+    def __init__(self):
+        self.cmds = []
+
+    def runcmd(self, cmd, if_stdout=False):
+        self.cmds.append(cmd)
+        starts = sum("virsh --connect" in c for c in self.cmds)
+        if "virsh --connect" in cmd:
+            return (1 if starts == 1 else 0), ""
+        return 0, "running\n"
+
+    def close(self):
+        pass
+
+
+def test_guest_start_retries_virtlogd():
+    libvirt = LibvirtCLI("libvirt.example.com", "root", "pwd")
+    libvirt.ssh = StartSSH()
+    for _ in range(3):
+        libvirt.guest_start("vm1")
+    starts = [c for c in libvirt.ssh.cmds if "virsh --connect" in c]
+    assert [c.startswith("systemctl start virtlogd.socket") for c in starts] == [
+        True,
+        True,
+        False,
+    ]
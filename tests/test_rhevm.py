@@ -0,0 +1,241 @@
+import pytest
+
+pytest.importorskip("paramiko")
+
+from hypervisor import FailException  # noqa: E402
+from hypervisor.virt.rhevm import rhevmcli  # noqa: E402
+from hypervisor.virt.rhevm.rhevmcli import RHEVMCLI  # noqa: E402
+
+
+class FakeSSH:
+    """SSHConnect replying with the given outputs in turn"""
+
+    def __init__(self, *outputs):
+        self.outputs = list(outputs)
+        self.cmds = []
+
+    def runcmd(self, cmd, if_stdout=False):
+        self.cmds.append(cmd)
+        return self.outputs.pop(0)
+
+
+def make_rhevm(*outputs):
+    rhevm = RHEVMCLI.__new__(RHEVMCLI)
+    rhevm.server = "rhevm.example.com"
+    rhevm.ssh = FakeSSH(*outputs)
+    rhevm._cache = {}
+    rhevm._guest_cache = {}
+    rhevm._info_cache = {}
+    rhevm._admin_option = ()
+    rhevm._sdk = None
+    rhevm._sdk_failed = False
+    return rhevm
+
+
+def test_ovirt_exec_single_command():
+    rhevm = make_rhevm((0, "name: host1\n"))
+    assert rhevm._ovirt_exec("show vm it's") == (0, ["name: host1\n"])
+    assert rhevm.ssh.cmds == ["ovirt-shell -c -E 'show vm it'\"'\"'s'"]
+
+
+def test_ovirt_exec_split():
+    marker = rhevmcli._MARKER
+    output = f"{marker}\nname: vm1\n{marker}\n\n{marker}\nname: host1\n"
+    rhevm = make_rhevm((0, output))
+    ret, outputs = rhevm._ovirt_exec("show vm vm1", "list vms", "list hosts")
+    assert ret == 0
+    assert outputs == ["\nname: vm1\n", "\n\n", "\nname: host1\n"]
+    script = rhevm.ssh.cmds[0]
+    assert script.startswith("ovirt-shell -c <<'EOF'\n")
+    assert script.count(f"echo {marker}\n") == 3
+
+
+def test_ovirt_exec_missing_section():
+    output = f"{rhevmcli._MARKER}\nname: vm1\n"
+    rhevm = make_rhevm((0, output))
+    with pytest.raises(FailException):
+        rhevm._ovirt_exec("show vm vm1", "list hosts")
+
+
+class FakeSdkConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_close_keeps_ssh():
+    rhevm = make_rhevm()
+    rhevm.ssh.close = lambda: pytest.fail("the shared ssh must not be closed")
+    connection = rhevm._sdk = FakeSdkConnection()
+    with rhevm:
+        pass
+    assert connection.closed
+    assert rhevm._sdk is None
+
+
+def test_info_many(monkeypatch):
+    created = []
+
+    def init(self, server, ssh_user, ssh_pwd, *admin_option):
+        self.__dict__.update(make_rhevm((0, f"name: {server}-host\n")).__dict__)
+        self.server = server
+        self.ssh.close = lambda: pytest.fail("the shared ssh must not be closed")
+        created.append(server)
+
+    monkeypatch.setattr(RHEVMCLI, "__init__", init)
+    servers = [("r1", "root", "pwd"), ("r2", "root", "pwd"), ("r1", "root", "pwd")]
+    assert RHEVMCLI.info_many(servers) == {"r1": ["r1-host"], "r2": ["r2-host"]}
+    assert sorted(created) == ["r1", "r2"]
+    assert RHEVMCLI.info_many([]) == {}
+
+
+class FakeSdkError(Exception):
+    pass
+
+
+class FakeSdk:
+    """ovirtsdk4 whose connection fails at the first query"""
+
+    Error = FakeSdkError
+
+    @staticmethod
+    def Connection(**kwargs):
+        return FailingConnection()
+
+
+class FailingConnection(FakeSdkConnection):
+    def system_service(self):
+        raise FakeSdkError("Failed to authenticate")
+
+
+def test_sdk_failure_falls_back_to_shell(monkeypatch):
+    monkeypatch.setattr(rhevmcli, "sdk", FakeSdk)
+    monkeypatch.setattr(rhevmcli, "_disk_cache", {})
+    rhevm = make_rhevm((0, "name: vm1\nstatus-state: up\n"), (0, "name: host1\n"))
+    rhevm._admin_option = ("admin@internal", "pwd")
+    rhevm._cache["url"] = (float("inf"), "https://rhevm.example.com/ovirt-engine")
+    assert rhevm.get_rhevm_info("vm", "vm1", "status-state") == "up"
+    assert rhevm._sdk is None and rhevm._sdk_failed
+    # ovirt-shell is used from now on
+    assert rhevm.info() == ["host1"]
+    assert len(rhevm.ssh.cmds) == 2
+
+
+class FakeService:
+    def __init__(self, objects):
+        self.objects = objects
+        self.searches = []
+
+    def list(self, search):
+        self.searches.append(search)
+        field, value = search.split("=")
+        return [o for o in self.objects if getattr(o, field) == value]
+
+
+class FakeObject:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_sdk_info_batch_one_search_per_object():
+    uuid = "8f3c9a52-5d0e-4c1e-9a3b-0f1e2d3c4b5a"
+    vms = FakeService([FakeObject(id=uuid, name="vm1", memory=1024)])
+    services = {"vm": vms, "host": FakeService([]), "cluster": FakeService([])}
+    connection = FakeObject(
+        system_service=lambda: FakeObject(
+            vms_service=lambda: services["vm"],
+            hosts_service=lambda: services["host"],
+            clusters_service=lambda: services["cluster"],
+        )
+    )
+    queries = [("vm", "vm1", "id"), ("vm", "vm1", "memory"), ("vm", uuid, "name")]
+    results = make_rhevm()._sdk_info_batch(connection, queries)
+    assert results == {queries[0]: uuid, queries[1]: "1024", queries[2]: "vm1"}
+    assert vms.searches == ["name=vm1", f"id={uuid}"]
+
+
+NMAP = """Nmap scan report for 10.0.0.5
+Host is up.
+MAC Address: 56:6F:00:00:00:01 (Unknown)
+"""
+
+
+@pytest.mark.parametrize(
+    "cache, scans",
+    [
+        # no cached scan, a miss does not scan again
+        ({}, 1),
+        # an expired scan is replaced once
+        ({("nmap", "10.0.0.0/24"): (0, {"56:6f:00:00:00:09": "10.0.0.9"})}, 1),
+        # a fresh scan without the guest is replaced once
+        (
+            {("nmap", "10.0.0.0/24"): (float("inf"), {"56:6f:00:00:00:09": "x"})},
+            1,
+        ),
+    ],
+)
+def test_get_guest_ip_scans_once(monkeypatch, cache, scans):
+    host = FakeSSH(*([(0, "")] + [(0, "Nmap done\n")] * 2))
+    monkeypatch.setattr(rhevmcli, "SSHConnect", lambda *args: host)
+    rhevm = make_rhevm()
+    rhevm._cache.update(cache)
+    rhevm._guest_cache["vm1"] = {"mac": "56:6f:00:00:00:01"}
+    monkeypatch.setattr(rhevm, "get_gateway", lambda *args: "10.0.0.0/24")
+    assert rhevm.get_guest_ip("vm1", "host", "root", "pwd") is None
+    assert sum(cmd.startswith("nmap") for cmd in host.cmds) == scans
+
+
+def test_get_guest_ip_nmap(monkeypatch):
+    host = FakeSSH((0, ""), (0, NMAP))
+    monkeypatch.setattr(rhevmcli, "SSHConnect", lambda *args: host)
+    rhevm = make_rhevm()
+    rhevm._guest_cache["vm1"] = {"mac": "56:6f:00:00:00:01"}
+    monkeypatch.setattr(rhevm, "get_gateway", lambda *args: "10.0.0.0/24")
+    assert rhevm.get_guest_ip("vm1", "host", "root", "pwd") == "10.0.0.5"
+    # the scan is cached for the other guests
+    _, ips = rhevm._cache[("nmap", "10.0.0.0/24")]
+    assert ips == {"56:6f:00:00:00:01": "10.0.0.5"}
+
+
+def test_get_guest_ip_neigh(monkeypatch):
+    host = FakeSSH((0, "10.0.0.7\n"))
+    monkeypatch.setattr(rhevmcli, "SSHConnect", lambda *args: host)
+    rhevm = make_rhevm()
+    rhevm._guest_cache["vm1"] = {"mac": "56:6F:00:00:00:01"}
+    assert rhevm.get_guest_ip("vm1", "host", "root", "pwd") == "10.0.0.7"
+    assert host.cmds[0].startswith("ip -4 neigh show | awk -v m=56:6f:00:00:00:01 ")
+
+
+def test_get_guest_ip_without_mac(monkeypatch):
+    host = FakeSSH()
+    monkeypatch.setattr(rhevmcli, "SSHConnect", lambda *args: host)
+    rhevm = make_rhevm()
+    monkeypatch.setattr(rhevm, "get_guest_mac", lambda guest_name: None)
+    assert rhevm.get_guest_ip("vm1", "host", "root", "pwd") is None
+    assert host.cmds == []
+
+
+def test_save_disk_cache(tmp_path, monkeypatch):
+    cache_file = tmp_path / "cache" / "rhevm.json"
+    monkeypatch.setattr(rhevmcli, "_DISK_CACHE_FILE", str(cache_file))
+    monkeypatch.setattr(
+        rhevmcli, "_disk_cache", {"fresh": [4102444800, "a"], "old": [0, "b"]}
+    )
+    rhevmcli._save_disk_cache()
+    assert cache_file.read_text() == '{"fresh": [4102444800, "a"]}'
+    assert [p.name for p in cache_file.parent.iterdir()] == ["rhevm.json"]
+
+
+def test_save_disk_cache_read_only(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    monkeypatch.setattr(rhevmcli, "_DISK_CACHE_FILE", str(cache_dir / "rhevm.json"))
+    monkeypatch.setattr(rhevmcli, "_disk_cache", {"fresh": [float("inf"), "a"]})
+
+    def replace(src, dst):
+        raise PermissionError("Read-only file system")
+
+    monkeypatch.setattr(rhevmcli.os, "replace", replace)
+    rhevmcli._save_disk_cache()
+    assert list(cache_dir.iterdir()) == []
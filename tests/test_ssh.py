@@ -0,0 +1,201 @@
+import threading
+
+import pytest
+
+pytest.importorskip("paramiko")
+
+from hypervisor import ssh  # noqa: E402
+from hypervisor.ssh import SSHConnect  # noqa: E402
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+
+class FakeClient:
+    def __init__(self, host):
+        self.host = host
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport.active = False
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """Connect with FakeClient, in an empty pool"""
+    monkeypatch.setattr(SSHConnect, "_pool", {})
+    monkeypatch.setattr(SSHConnect, "_pool_users", {})
+    monkeypatch.setattr(SSHConnect, "_pool_locks", {})
+    monkeypatch.setattr(SSHConnect, "_connect", lambda self: FakeClient(self.host))
+    return SSHConnect._pool
+
+
+class FakeHostOutput:
+    """HostOutput of parallel-ssh, the exit code is only known once the
+    stdout is consumed"""
+
+    def __init__(self, host, lines, code):
+        self.host = host
+        self._lines = lines
+        self._code = code
+        self.exit_code = None
+
+    @property
+    def stdout(self):
+        yield from self._lines
+        self.exit_code = self._code
+
+
+class FakeParallelSSHClient:
+    def __init__(self, hosts, **kwargs):
+        self.hosts = hosts
+
+    def run_command(self, cmd):
+        return [FakeHostOutput(h, [cmd, h], i) for i, h in enumerate(self.hosts)]
+
+    def join(self, output):
+        if not isinstance(output, list):
+            raise ValueError("Unexpected output object type")
+
+
+def test_runcmd_all_pssh(monkeypatch):
+    monkeypatch.setattr(ssh, "ParallelSSHClient", FakeParallelSSHClient)
+    results = ssh.runcmd_all(["h1", "h2"], "uptime", "root", "pwd")
+    assert results == {"h1": (0, "uptime\nh1"), "h2": (1, "uptime\nh2")}
+
+
+def test_runcmd_all_thread_pool(monkeypatch):
+    monkeypatch.setattr(ssh, "ParallelSSHClient", None)
+    monkeypatch.setattr(
+        SSHConnect, "runcmd", lambda self, cmd, if_stdout=False: (0, self.host)
+    )
+    results = ssh.runcmd_all(["h1", "h2"], "uptime", "root", "pwd")
+    assert results == {"h1": (0, "h1"), "h2": (0, "h2")}
+
+
+def test_persistent_connect_reuse(pool):
+    client = SSHConnect("h1", "root", "pwd")._persistent_connect()
+    assert client.transport.keepalive == 30
+    assert SSHConnect("h1", "root", "pwd")._persistent_connect() is client
+    assert SSHConnect("h2", "root", "pwd")._persistent_connect() is not client
+    client.close()
+    assert SSHConnect("h1", "root", "pwd")._persistent_connect() is not client
+
+
+def test_persistent_connect_slow_host(pool, monkeypatch):
+    connecting, release = threading.Event(), threading.Event()
+
+    def connect(self):
+        if self.host == "slow":
+            connecting.set()
+            release.wait(10)
+        return FakeClient(self.host)
+
+    monkeypatch.setattr(SSHConnect, "_connect", connect)
+    slow = threading.Thread(
+        target=SSHConnect("slow", "root", "pwd")._persistent_connect
+    )
+    slow.start()
+    try:
+        assert connecting.wait(10)
+        fast = threading.Thread(
+            target=SSHConnect("fast", "root", "pwd")._persistent_connect
+        )
+        fast.start()
+        fast.join(5)
+        assert not fast.is_alive()
+        assert ("fast", 22, "root") in pool
+    finally:
+        release.set()
+        slow.join()
+
+
+def test_close_shared_connection(pool):
+    first = SSHConnect("h1", "root", "pwd")
+    second = SSHConnect("h1", "root", "pwd")
+    client = first._persistent_connect()
+    assert second._persistent_connect() is client
+    first.close()
+    # the connection is still used by the second instance
+    assert client.get_transport().is_active()
+    assert second._persistent_connect() is client
+    second.close()
+    assert not client.get_transport().is_active()
+    assert pool == {}
+    assert SSHConnect._pool_users == {}
+
+
+def test_close_unused(pool):
+    SSHConnect("h1", "root", "pwd").close()
+    client = SSHConnect("h1", "root", "pwd")._persistent_connect()
+    SSHConnect("h1", "root", "pwd").close()
+    assert client.get_transport().is_active()
+
+
+class FakeChannel:
+    def __init__(self, output):
+        self.output = [(len(output), output), (0, b"")]
+
+    def execute(self, cmd):
+        self.cmd = cmd
+
+    def read(self):
+        return self.output.pop(0)
+
+    def read_stderr(self):
+        return 0, b""
+
+    def close(self):
+        pass
+
+    def wait_closed(self):
+        pass
+
+    def get_exit_status(self):
+        return 0
+
+
+class DroppedSession:
+    """libssh2 session dropped by the server"""
+
+    def open_session(self):
+        raise OSError("Socket disconnected")
+
+    def disconnect(self):
+        raise OSError("Socket disconnected")
+
+
+class FakeSession:
+    def open_session(self):
+        return FakeChannel(b"ok\n")
+
+
+class FakeSocket:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_ssh2_reconnect_dropped_session(monkeypatch):
+    connection = SSHConnect("h1", "root", "pwd")
+    connection.backend = "ssh2"
+    dropped = (DroppedSession(), FakeSocket())
+    connection._ssh2 = dropped
+    monkeypatch.setattr(
+        SSHConnect, "ssh2_connect", lambda self: (FakeSession(), FakeSocket())
+    )
+    assert connection.runcmd("uptime") == (0, "ok\n")
+    assert dropped[1].closed
+    assert isinstance(connection._ssh2[0], FakeSession)